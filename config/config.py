@@ -13,6 +13,8 @@ OUTPUT_BASE = "output"
 LOG_PATH = OUTPUT_BASE + "/logs/"
 RESULTS_PATH = OUTPUT_BASE + "/results/"
 POPULATION_PICKLE_PATH = OUTPUT_BASE + "/population.p"
+FITNESS_CACHE_PATH = OUTPUT_BASE + "/fitness_cache.sqlite"
+USE_FITNESS_CACHE = True    # Reuse results of identical encodes from earlier runs
 CLI_VERBOSITY = "INFO"  # ERROR, WARNING, INFO, DEBUG
 
 
@@ -23,6 +25,20 @@ NO_GENERATIONS = 10
 MOG_ALG = "nsga2"   # nsga2, nspso, moead
 EPOCHS = 1
 
+# Surrogate mode: offspring are bred on Gaussian process models of the fitness trained on the
+# data.csv history of RESULTS_PATH, only the POP_SIZE most promising are evaluated (utils/surrogate.py)
+SURROGATE_MODE = False
+SURROGATE_MIN_HISTORY = 50      # Evaluations of the encoder and rate control needed to use the surrogate
+SURROGATE_MAX_HISTORY = 1000    # Latest evaluations the surrogate is trained on
+SURROGATE_OVERSAMPLING = 4      # Generations bred on the surrogate for every evaluated generation
+SURROGATE_MAX_STD = 0.5         # Evaluate plain offspring if the predictions are more uncertain (std of the history)
+
+# Archipelago mode: an island per algorithm of ARCHIPELAGO_ALGS is evolved in a process of its own,
+# the islands form a ring which migrates the best individuals of an island to its neighbour
+ARCHIPELAGO_MODE = False
+ARCHIPELAGO_ALGS = ["nsga2", "moead", "nspso"]
+ARCHIPELAGO_MIGRATION_RATE = 0.25   # Probability that an island receives migrants in a generation
+
 # Encoder/s and rate control/s to optimise for
 VIDEO_ENCODERS = ["libx264"]
 RATE_CONTROLS = {"h264_nvenc": ["CQP"],
@@ -49,30 +65,89 @@ ML_MODEL_PARAMS = {
     "hrnet": {
         "ML_PERFORMANCE_BASELINE": 0.8162191842797382,
         "ML_PERFORMANCE_MEASURE": "mean_IoU",
-        "ML_DATA_OUTPUT": ML_DATA_BASE + "/HRNet-mldata/cityscapes/leftImg8bit/val/"
+        "ML_DATA_ROOT": ML_DATA_BASE + "/HRNet-mldata/",
+        "ML_DATA_OUTPUT": ML_DATA_BASE + "/HRNet-mldata/cityscapes/leftImg8bit/val/",
+        "ML_DATA_SHARED": ["cityscapes/gtFine", "list"],
+        "ML_DATA_LIST": "list/cityscapes/val.lst"
     },
     "gscnn": {
         "ML_PERFORMANCE_BASELINE": 0.806058279492062,
         "ML_PERFORMANCE_MEASURE": "mean_iu",
-        "ML_DATA_OUTPUT": ML_DATA_BASE + "/GSCNN-mldata/cityscapes/leftImg8bit_trainvaltest/leftImg8bit/val/"
+        "ML_DATA_ROOT": ML_DATA_BASE + "/GSCNN-mldata/cityscapes/",
+        "ML_DATA_OUTPUT": ML_DATA_BASE + "/GSCNN-mldata/cityscapes/leftImg8bit_trainvaltest/leftImg8bit/val/",
+        "ML_DATA_SHARED": ["gtFine_trainvaltest", "leftImg8bit_trainvaltest/leftImg8bit/train"],
+        "ML_DATA_LIST": None
     }
 }
 
 ML_PERFORMANCE_BASELINE = ML_MODEL_PARAMS[ML_MODEL]["ML_PERFORMANCE_BASELINE"]
 ML_PERFORMANCE_MEASURE = ML_MODEL_PARAMS[ML_MODEL]["ML_PERFORMANCE_MEASURE"]
 ML_DATA_OUTPUT = ML_MODEL_PARAMS[ML_MODEL]["ML_DATA_OUTPUT"]
+ML_DATA_ROOT = ML_MODEL_PARAMS[ML_MODEL]["ML_DATA_ROOT"]       # Dataset root of the ML-algorithm
+ML_DATA_SHARED = ML_MODEL_PARAMS[ML_MODEL]["ML_DATA_SHARED"]   # Parts of the root shared by every evaluation
+ML_DATA_LIST = ML_MODEL_PARAMS[ML_MODEL]["ML_DATA_LIST"]       # Image list of the validation set, None if the images are listed from disk
+
+# Every evaluation of the optimisation writes its degraded clips to a slot of its own
+# (utils/output_pool.py), a copy of ML_DATA_ROOT with its own ML_DATA_OUTPUT directory
+ML_DATA_POOL_PATH = ML_DATA_BASE + "/eval-pool/" + ML_MODEL + "/"
+ML_DATA_POOL_SIZE = 3
+PIPELINE_DEPTH = 1  # Chromosomes of a batch transcoded ahead of the ML-evaluation, 0 disables pipelining
+
+# Multi-fidelity mode: chromosomes are first scored on a subset of the dataset (utils/multi_fidelity.py)
+# and only evaluated on the full dataset if no full evaluation clearly dominates them
+MULTI_FIDELITY = False
+MULTI_FIDELITY_INPUT = ML_DATA_BASE + "/Cityscapes-dataset/multi-fidelity/"    # Subset of ML_DATA_INPUT, created on start
+MULTI_FIDELITY_STRIDE = 4           # Every MULTI_FIDELITY_STRIDE:th annotated sequence of every clip is in the subset
+MULTI_FIDELITY_LIST = "multi-fidelity"  # Evaluation list of the subset, for ML-algorithms with an ML_DATA_LIST
+MULTI_FIDELITY_MARGIN = 0.02        # ML-performance margin of a clearly dominated chromosome
+MULTI_FIDELITY_CR_MARGIN = 0.1      # Relative compression-ratio margin of a clearly dominated chromosome
+
+# Early rejection: encodes which are dominated by a full evaluation, given their compression ratio and an
+# upper bound of their ML-performance, are never sent to the ML-algorithm. The bound is the ML-performance on the
+# original dataset (ML_PERFORMANCE_BASELINE) plus EARLY_REJECTION_MARGIN. Needs EVAL_BACKEND local
+EARLY_REJECTION = False
+EARLY_REJECTION_MARGIN = 0.01   # ML-performance an encode may gain over the bound
+# Heuristic, not a proof: tightens the bound to the ML-performance of full evaluations of equal or better PSNR and
+# SSIM (QUALITY_METRICS). ML-performance is not monotonic in PSNR and SSIM, so encodes which would have been
+# non-dominated may be rejected and given a pessimistic score
+EARLY_REJECTION_QUALITY_BOUND = False
+
+# Evaluation backend, local: chromosomes are transcoded and evaluated on this machine, queue: chromosomes are
+# submitted as jobs to the job queue (utils/job_queue.py) and evaluated by workers (tools/eval-worker.py)
+EVAL_BACKEND = "local"
+JOB_QUEUE_PATH = OUTPUT_BASE + "/job_queue.sqlite"  # Shared by the optimisation and every worker
+JOB_LEASE_TIME = 120    # Seconds a job stays leased without renewal, jobs of crashed workers are then re-queued
+JOB_MAX_ATTEMPTS = 3    # Failed attempts of a job before its evaluation fails
+JOB_POLL_INTERVAL = 1   # Seconds between polls of the job queue
+JOB_WAIT_TIMEOUT = 4*60*60  # Seconds after submission the optimisation waits for a job before it fails
 
 
 # rest_communication parameters
 ML_ADDRESS = "http://localhost:5001"
 REQUEST_ADDRESS = ML_ADDRESS + "/eval" 
+MODEL_ADDRESS = ML_ADDRESS + "/model"   # Reports the checkpoint of the ML-algorithm, part of the fitness cache key
 
 
 # ffmpeg_utils parameters
-TEMP_STORAGE_PATH = "/tmp/temp.mp4" # change to tmp/temp.mp4 to use system drive instead of /tmp - tmpfs mount
+TEMP_STORAGE_DIR = "/tmp"   # Scratch space of transcode jobs, change to tmp to use system drive instead of /tmp - tmpfs mount
+TRANSCODE_WORKERS = 4   # Number of clips transcoded concurrently, 1 transcodes clips one at a time
+TRANSCODE_LOCK_PATH = TEMP_STORAGE_DIR + "/moga-transcode-workers/"    # Locks which share the workers between processes
+TRANSCODE_THREADS = 0   # Threads (slots) given to each transcode worker, 0 lets ffmpeg decide. Part of the fitness key
 IMAGE_TYPE = "png"
 NAMING_SCHEME =  '%06d'  # imgtype=png & scheme='%d' --> 1.png, 2.png, 3.png...
 IMG_COMP_LVL = 1
+# png: degraded frames are written as images, rawvideo: degraded frames are piped from
+# ffmpeg as raw video into a memory-mapped frame store (utils/frame_store.py) which the
+# evaluator reads directly, skipping png compression and decompression. Only GSCNN reads frame stores
+FRAME_PIPELINE = "png"
+if FRAME_PIPELINE == "rawvideo" and ML_MODEL == "hrnet":
+    raise ValueError("FRAME_PIPELINE rawvideo is not supported by ML_MODEL hrnet, HRNet cannot read frame stores")
+SOURCE_FRAME_CACHE = False  # Decode the input datasets once into frame stores which all encodes are fed from
+SOURCE_CACHE_PATH = ML_DATA_BASE + "/source-cache/"
+EVAL_FRAMES_ONLY = False    # Encode every frame but only decode the frames which are evaluated
+EVAL_FRAME_PERIOD = 30      # Cityscapes: frame EVAL_FRAME_OFFSET of every sequence of
+EVAL_FRAME_OFFSET = 19      # EVAL_FRAME_PERIOD frames is annotated and evaluated
+QUALITY_METRICS = False     # Compare the decoded frames of every encode with their source using ffmpeg's psnr and ssim filters, in the decode pass
 JSON_PARAM_PATH_BASE = "config/encoding_parameters"
 
 
@@ -92,6 +167,10 @@ video_encoder = None
 rate_control = None
 no_continous = None
 
+# Configuration set at runtime, restored in the processes of archipelago islands
+RUN_STATE = ("timestamp", "epoch", "opt_params", "opt_high_bounds", "opt_low_bounds", "opt_type",
+             "opt_cat_values", "opt_constants", "video_encoder", "rate_control", "no_continous", "MOG_ALG")
+
 def load_params_from_json(encoder, r_control):
     '''
     Load optimisation parameters and bounds from dictionary
@@ -131,17 +210,46 @@ def load_params_from_json(encoder, r_control):
     logger.debug("Params loaded: " + str(opt_params))
 
 
+def get_run_state():
+    '''
+    Returns the configuration set at runtime (RUN_STATE)
+    '''
+    return {name: globals()[name] for name in RUN_STATE}
+
+
+def restore_run_state(state):
+    '''
+    Restores a configuration of get_run_state in another process, logging
+    to the logfile of the run if the process has not configured logging
+    '''
+    globals().update(state)
+    if not logging.getLogger('gen-alg').handlers: configure_logging(state["timestamp"])
+
+
+def check_config():
+    '''
+    Checks the combinations of settings at startup.
+    Raises ValueError if settings cannot be combined, warns if they are ineffective
+    '''
+    if EARLY_REJECTION and EVAL_BACKEND == "queue":
+        raise ValueError("EARLY_REJECTION is not supported by EVAL_BACKEND queue, workers evaluate every job")
+    if EARLY_REJECTION and EARLY_REJECTION_QUALITY_BOUND and not QUALITY_METRICS:
+        logger.warning("EARLY_REJECTION_QUALITY_BOUND has no effect without QUALITY_METRICS, " +
+                       "encodes are only rejected if they cannot beat ML_PERFORMANCE_BASELINE")
+
+
 def get_random_seed(ep):
     '''An arbitrary but repeatable randomisation seed'''
     return ep*3+1
 
 
-def configure_logging():
+def configure_logging(run_timestamp=None):
     '''
     Configures the logging of information in logfiles and in CLIs.
+    A new run is started unless the timestamp of a run is given.
     '''
     global logger, timestamp
-    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    timestamp = run_timestamp or datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
     # Check/prepare directories for storing data from this session
     if not os.path.isdir(OUTPUT_BASE): os.mkdir(OUTPUT_BASE) 
@@ -14,6 +14,7 @@ import math
 import logging
 import datasets.cityscapes_labels as cityscapes_labels
 import json
+import hashlib
 from config import cfg
 import torchvision.transforms as transforms
 import datasets.edge_utils as edge_utils
@@ -23,6 +24,14 @@ id_to_trainid = cityscapes_labels.label2trainid
 num_classes = 19
 ignore_label = 255
 root = cfg.DATASET.CITYSCAPES_DIR
+# Masks remapped to train ids, shared by every root of the dataset
+mask_cache_dir = os.path.join(cfg.DATASET.CITYSCAPES_DIR, 'gtFine_trainid_cache')
+
+# Remaps label ids to train ids in one indexing operation, unlisted ids are kept
+id_to_trainid_lut = np.arange(256, dtype=np.uint8)
+for k, v in id_to_trainid.items():
+    if 0 <= k < 256:
+        id_to_trainid_lut[k] = v
 
 palette = [128, 64, 128, 244, 35, 232, 70, 70, 70, 102, 102, 156, 190, 153, 153,
            153, 153, 153, 250, 170, 30,
@@ -41,25 +50,76 @@ def colorize_mask(mask):
     return new_mask
 
 
+def has_frame_store(img_dir):
+    '''
+    Frame stores (frames.npy + frames.json) hold raw rgb24 frames written by
+    MOGA-Encode instead of png images
+    '''
+    return (os.path.isfile(os.path.join(img_dir, 'frames.npy')) and
+            os.path.isfile(os.path.join(img_dir, 'frames.json')))
+
+
+def read_frame_store_names(img_dir):
+    with open(os.path.join(img_dir, 'frames.json')) as names_file:
+        return json.load(names_file)
+
+
+def load_image(img_path):
+    '''
+    Loads an image file, or the frame of the same name from a frame store
+    '''
+    img_dir, img_name = os.path.split(img_path)
+    if has_frame_store(img_dir):
+        frames = np.load(os.path.join(img_dir, 'frames.npy'), mmap_mode='r')
+        frame = np.array(frames[read_frame_store_names(img_dir).index(img_name)])
+        return Image.fromarray(frame)
+    return Image.open(img_path).convert('RGB')
+
+
+def load_trainid_mask(mask_path):
+    '''
+    Loads a mask with its label ids remapped to train ids.
+    Remapped masks are cached as uint8 .npy files and memory-mapped, they
+    never change between evaluations
+    '''
+    real_path = os.path.realpath(mask_path)
+    cache_name = hashlib.sha1(real_path.encode('utf8')).hexdigest() + '.npy'
+    cache_path = os.path.join(mask_cache_dir, cache_name)
+    if os.path.isfile(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(real_path):
+        return np.load(cache_path, mmap_mode='r')
+
+    mask = id_to_trainid_lut[np.array(Image.open(mask_path))]
+    try:
+        os.makedirs(mask_cache_dir, exist_ok=True)
+        # Loader workers may cache the same mask, only complete files are moved in place
+        tmp_path = cache_path[:-len('.npy')] + '.' + str(os.getpid()) + '.tmp.npy'
+        np.save(tmp_path, mask)
+        os.replace(tmp_path, cache_path)
+    except OSError as err:
+        logging.warning('Could not cache mask {}: {}'.format(mask_path, err))
+    return mask
+
+
 def add_items(items, aug_items, cities, img_path, mask_path, mask_postfix, mode, maxSkip):
 
     for c in cities:
-        c_items = [name.split('_leftImg8bit.png')[0] for name in
-                   os.listdir(os.path.join(img_path, c))]
+        city_dir = os.path.join(img_path, c)
+        city_names = read_frame_store_names(city_dir) if has_frame_store(city_dir) else os.listdir(city_dir)
+        c_items = [name.split('_leftImg8bit.png')[0] for name in city_names]
         for it in c_items:
             if os.path.exists(os.path.join(mask_path, c, it + mask_postfix)):
                 item = (os.path.join(img_path, c, it + '_leftImg8bit.png'),
                             os.path.join(mask_path, c, it + mask_postfix))
                 items.append(item)
 
-def make_cv_splits(img_dir_name):
+def make_cv_splits(img_dir_name, data_root=root):
     '''
     Create splits of train/val data.
     A split is a lists of cities.
     split0 is aligned with the default Cityscapes train/val.
     '''
-    trn_path = os.path.join(root, img_dir_name, 'leftImg8bit', 'train')
-    val_path = os.path.join(root, img_dir_name, 'leftImg8bit', 'val')
+    trn_path = os.path.join(data_root, img_dir_name, 'leftImg8bit', 'train')
+    val_path = os.path.join(data_root, img_dir_name, 'leftImg8bit', 'val')
 
     trn_cities = ['train/' + c for c in os.listdir(trn_path)]
     val_cities = ['val/' + c for c in os.listdir(val_path)]
@@ -101,16 +161,16 @@ def make_split_coarse(img_path):
     split['train'] = [c for c in all_cities if c not in val_cities]
     return split
 
-def make_test_split(img_dir_name):
-    test_path = os.path.join(root, img_dir_name, 'leftImg8bit', 'test')
+def make_test_split(img_dir_name, data_root=root):
+    test_path = os.path.join(data_root, img_dir_name, 'leftImg8bit', 'test')
     test_cities = ['test/' + c for c in os.listdir(test_path)]
 
     return test_cities
 
 
-def make_dataset(quality, mode, maxSkip=0, fine_coarse_mult=6, cv_split=0):
+def make_dataset(quality, mode, maxSkip=0, fine_coarse_mult=6, cv_split=0, data_root=root):
     '''
-    Assemble list of images + mask files
+    Assemble list of images + mask files of the dataset in data_root
 
     fine -   modes: train/val/test/trainval    cv:0,1,2
     coarse - modes: train/val                  cv:na
@@ -125,17 +185,17 @@ def make_dataset(quality, mode, maxSkip=0, fine_coarse_mult=6, cv_split=0):
     if quality == 'fine':
         assert mode in ['train', 'val', 'test', 'trainval']
         img_dir_name = 'leftImg8bit_trainvaltest'
-        img_path = os.path.join(root, img_dir_name, 'leftImg8bit')
-        mask_path = os.path.join(root, 'gtFine_trainvaltest', 'gtFine')
+        img_path = os.path.join(data_root, img_dir_name, 'leftImg8bit')
+        mask_path = os.path.join(data_root, 'gtFine_trainvaltest', 'gtFine')
         mask_postfix = '_gtFine_labelIds.png'
-        cv_splits = make_cv_splits(img_dir_name)
+        cv_splits = make_cv_splits(img_dir_name, data_root)
         if mode == 'trainval':
             modes = ['train', 'val']
         else:
             modes = [mode]
         for mode in modes:
             if mode == 'test':
-                cv_splits = make_test_split(img_dir_name)
+                cv_splits = make_test_split(img_dir_name, data_root)
                 add_items(items, cv_splits, img_path, mask_path,
                       mask_postfix)
             else:
@@ -154,8 +214,10 @@ class CityScapes(data.Dataset):
     def __init__(self, quality, mode, maxSkip=0, joint_transform=None, sliding_crop=None,
                  transform=None, target_transform=None, dump_images=False,
                  cv_split=None, eval_mode=False, 
-                 eval_scales=None, eval_flip=False):
+                 eval_scales=None, eval_flip=False, imgs=None, data_root=None):
         self.quality = quality
+        # Every dataset has its own root, concurrent evaluations may use different roots
+        self.root = data_root if data_root != None else root
         self.mode = mode
         self.maxSkip = maxSkip
         self.joint_transform = joint_transform
@@ -176,7 +238,11 @@ class CityScapes(data.Dataset):
                     cv_split, cfg.DATASET.CV_SPLITS)
         else:
             self.cv_split = 0
-        self.imgs, _ = make_dataset(quality, mode, self.maxSkip, cv_split=self.cv_split)
+        # imgs replaces the (image, mask) items found in the dataset root
+        if imgs != None:
+            self.imgs = list(imgs)
+        else:
+            self.imgs, _ = make_dataset(quality, mode, self.maxSkip, cv_split=self.cv_split, data_root=self.root)
         if len(self.imgs) == 0:
             raise RuntimeError('Found 0 images, please check the data set')
 
@@ -204,16 +270,11 @@ class CityScapes(data.Dataset):
 
         img_path, mask_path = self.imgs[index]
 
-        img, mask = Image.open(img_path).convert('RGB'), Image.open(mask_path)
+        img, mask_copy = load_image(img_path), load_trainid_mask(mask_path)
         img_name = os.path.splitext(os.path.basename(img_path))[0]
 
-        mask = np.array(mask)
-        mask_copy = mask.copy()
-        for k, v in id_to_trainid.items():
-            mask_copy[mask == k] = v
-
         if self.eval_mode:
-            return self._eval_get_item(img, mask_copy, self.eval_scales, self.eval_flip), img_name
+            return self._eval_get_item(img, np.array(mask_copy), self.eval_scales, self.eval_flip), img_name
 
         mask = Image.fromarray(mask_copy.astype(np.uint8))
 
@@ -16,14 +16,18 @@ import sys
 import gc
 
 import torch
+import torchvision.transforms as standard_transforms
 import numpy as np
 
 from utils.misc import AverageMeter, prep_experiment, evaluate_eval, fast_hist
 from utils.f_boundary import eval_mask_boundary
+from utils.hist_cache import HistCache, read_image_bytes, get_file_digest
 import datasets
+from datasets import cityscapes
 import loss
 import network
 import optimizer
+import transforms.transforms as extended_transforms
 
 # Argument Parser
 parser = argparse.ArgumentParser(description='GSCNN')
@@ -105,55 +109,176 @@ parser.add_argument('--test_mode', action='store_true', default=False,
                     help='minimum testing (1 epoch run ) to verify nothing failed')
 parser.add_argument('-wb', '--wt_bound', type=float, default=1.0)
 parser.add_argument('--maxSkip', type=int, default=0)
-args = parser.parse_args()
-args.best_record = {'epoch': -1, 'iter': 0, 'val_loss': 1e10, 'acc': 0,
-                        'acc_cls': 0, 'mean_iu': 0, 'fwavacc': 0}
+parser.add_argument('--cpu', action='store_true', default=False,
+                    help='Evaluate on the CPU, disables synchronized BN')
+parser.add_argument('--fscore', action='store_true', default=False,
+                    help='also evaluate the boundary F score, bypasses the histogram cache')
+parser.add_argument('--hist_cache', type=str, default='/data/GSCNN-mldata/hist-cache.sqlite',
+                    help='per-image histogram cache, empty to always infer every image')
 
-#Enable CUDNN Benchmarking optimization
-torch.backends.cudnn.benchmark = True
-args.world_size = 1
-#Test Mode run two epochs with a few iterations of training and val
-if args.test_mode:
-    args.max_epoch = 2
 
-if 'WORLD_SIZE' in os.environ:
-    args.world_size = int(os.environ['WORLD_SIZE'])
-    print("Total world size: ", int(os.environ['WORLD_SIZE']))
+def parse_args(argv=None):
+    '''
+    Parses the arguments of argv, the command-line if not given
+    '''
+    args = parser.parse_args(argv)
+    args.best_record = {'epoch': -1, 'iter': 0, 'val_loss': 1e10, 'acc': 0,
+                            'acc_cls': 0, 'mean_iu': 0, 'fwavacc': 0}
 
+    args.world_size = 1
+    #Test Mode run two epochs with a few iterations of training and val
+    if args.test_mode:
+        args.max_epoch = 2
 
+    if 'WORLD_SIZE' in os.environ:
+        args.world_size = int(os.environ['WORLD_SIZE'])
+        print("Total world size: ", int(os.environ['WORLD_SIZE']))
 
-#Set up the Arguments, Tensorboard Writer, Dataloader, Loss Fn, Optimizer
-assert_and_infer_cfg(args)
-writer = prep_experiment(args,parser)
+    if args.cpu:
+        args.syncbn = False
+    if args.snapshot == None:
+        args.snapshot = "checkpoints/best_cityscapes_checkpoint.pth"
+    return args
 
-default_eval_epoch = 1
 
+class Evaluator(object):
+    '''
+    Holds the restored network between evaluations, an evaluation then
+    only lists the images of the dataset and runs inference.
+    Runs on the CPU if --cpu is given or CUDA is unavailable.
+    '''
 
-def main(eval_args=None):
+    def __init__(self, argv=None):
+        self.args = parse_args(argv)
+        self.args.dataset_cls = cityscapes
+        self.device = torch.device('cuda' if torch.cuda.is_available() and not self.args.cpu else 'cpu')
+
+        #Enable CUDNN Benchmarking optimization
+        torch.backends.cudnn.benchmark = True
+
+        #Set up the Arguments, Tensorboard Writer
+        assert_and_infer_cfg(self.args)
+        self.writer = prep_experiment(self.args, parser)
+
+        # No loss is computed during evaluation
+        net = network.get_model(network=self.args.arch, num_classes=cityscapes.num_classes,
+                                criterion=None, trunk=self.args.trunk)
+        # Snapshots are saved from DataParallel, which runs the module directly on the CPU
+        net = torch.nn.DataParallel(net)
+        net = restore_snapshot(net, self.args.snapshot)
+        self.net = net.to(self.device)
+        self.net.eval()
+        # Identifies the checkpoint to clients which cache results
+        self.model_id = get_file_digest(self.args.snapshot)
+
+        mean_std = ([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+        self.input_transform = standard_transforms.Compose([
+            standard_transforms.ToTensor(),
+            standard_transforms.Normalize(*mean_std)
+        ])
+        self.target_transform = extended_transforms.MaskToTensor()
+
+        self.hist_cache = None
+        if self.args.hist_cache:
+            self.hist_cache = HistCache(self.args.hist_cache, self.args.snapshot, cityscapes.num_classes)
+
+    def get_dataset(self, eval_root=None, imgs=None):
+        '''
+        Returns the cityscapes validation set of eval_root, the configured
+        root if not given. imgs, a list of (image, mask) paths, replaces the
+        images listed from the root
+        '''
+        return cityscapes.CityScapes('fine', 'val', 0,
+                                     transform=self.input_transform,
+                                     target_transform=self.target_transform,
+                                     cv_split=self.args.cv, imgs=imgs,
+                                     data_root=eval_root if eval_root != None else cfg.DATASET.CITYSCAPES_DIR)
+
+    def get_loader(self, val_set):
+        ngpu = torch.cuda.device_count() if self.device.type == 'cuda' else 1
+        return torch.utils.data.DataLoader(val_set, batch_size=self.get_loader_batch_size(),
+                                           num_workers=2 * ngpu, shuffle=False, drop_last=False,
+                                           pin_memory=self.device.type == 'cuda')
+
+    def get_inference_settings(self):
+        '''
+        Returns the options which affect the predictions besides the snapshot,
+        histograms inferred with other options are not reused
+        '''
+        return {"arch": self.args.arch, "trunk": self.args.trunk, "device": self.device.type,
+                "batch_size": self.get_loader_batch_size()}
+
+    def get_loader_batch_size(self):
+        ngpu = torch.cuda.device_count() if self.device.type == 'cuda' else 1
+        return self.args.bs_mult_val * ngpu
+
+    def evaluate(self, eval_root=None, imgs=None):
+        '''
+        Evaluates the network on the validation set of eval_root, or the images imgs.
+        Only images without a cached histogram are inferred.
+        '''
+        val_set = self.get_dataset(eval_root, imgs)
+        # F scores are not cached, they need every image to be inferred
+        if self.hist_cache == None or self.args.fscore:
+            return evaluate(self.get_loader(val_set), self.net, self.args, self.device)
+
+        keys = {}
+        settings = self.get_inference_settings()
+        for img_path, mask_path in val_set.imgs:
+            img_bytes = read_image_bytes(img_path, cityscapes.load_image)
+            # Masks are keyed relative to the root, every evaluation directory shares them
+            keys[get_image_name(img_path)] = self.hist_cache.get_key(
+                img_bytes, os.path.relpath(mask_path, val_set.root), settings)
+        hists = self.hist_cache.lookup(keys.values())
+
+        uncached = [item for item in val_set.imgs if keys[get_image_name(item[0])] not in hists]
+        logging.info('Cached histograms: %d, images to infer: %d' % (len(val_set.imgs) - len(uncached), len(uncached)))
+        if len(uncached) > 0:
+            val_set.imgs = uncached
+            inferred, _, _ = infer_histograms(self.get_loader(val_set), self.net, self.args, self.device)
+            inferred = {keys[name]: hist for name, hist in inferred.items()}
+            self.hist_cache.store(inferred)
+            hists.update(inferred)
+
+        return get_measures(sum(hists[key] for key in keys.values()))
+
+
+def main(eval_args=None, eval_root=None):
     '''
     Main Function
-
+    eval_root: cityscapes root to evaluate instead of the configured one
     '''
-    # Parse arguments from rest_communication.py
-    #args = parser.parse_args(eval_args)
-    if args.snapshot == None:
-        args.snapshot = "checkpoints/best_cityscapes_checkpoint.pth"
-    
-    train_loader, val_loader, train_obj = datasets.setup_loaders(args)
-    criterion, criterion_val = loss.get_loss(args)
-    net = network.get_net(args, criterion)
-    net = restore_snapshot(net)
+    evaluator = Evaluator(eval_args)
     torch.cuda.empty_cache()
+    return evaluator.evaluate(eval_root)
+
+
+def get_image_name(img_path):
+    return os.path.splitext(os.path.basename(img_path))[0]
 
-    return evaluate(val_loader, net)
+
+def evaluate(val_loader, net, args, device):
+    '''
+    Evaluates every image of val_loader
+    return: the measures of the validation set
+    '''
+    hists, Fpc, Fc = infer_histograms(val_loader, net, args, device)
+    results = get_measures(sum(hists.values()))
+    if args.fscore:
+        logging.info('F_Score (Classwise): ' + str(Fpc/Fc))
+        results["F_score"] = np.sum(Fpc/Fc)/args.dataset_cls.num_classes
+    return results
 
 
-def evaluate(val_loader, net):
+def infer_histograms(val_loader, net, args, device):
     '''
     Runs the evaluation loop and prints F score
     val_loader: Data loader for validation
     net: thet network
-    return: 
+    args: the evaluation arguments
+    device: the device of the network
+    return: the confusion histogram of every image, by image name, and the
+            summed F scores and image counts of every class if args.fscore is set
     '''
     net.eval()
     # 0.0005   13.0 it/sec
@@ -166,7 +291,7 @@ def evaluate(val_loader, net):
     mf_pc_score1 = AverageMeter()
     ap_score1 = AverageMeter()
     ap_pc_score1 = AverageMeter()
-    IOU_acc = 0
+    hists = {}
     Fpc = np.zeros((args.dataset_cls.num_classes))
     Fc = np.zeros((args.dataset_cls.num_classes))
     for vi, data in enumerate(val_loader):
@@ -176,7 +301,7 @@ def evaluate(val_loader, net):
         h, w = mask.size()[1:]
 
         batch_pixel_size = input.size(0) * input.size(2) * input.size(3)
-        input, mask_cuda, edge_cuda = input.cuda(), mask.cuda(), edge.cuda()
+        input = input.to(device)
 
         with torch.no_grad():
             seg_out, edge_out = net(input)
@@ -185,19 +310,25 @@ def evaluate(val_loader, net):
         edge_predictions = edge_out.max(1)[0].cpu()
 
         logging.info('evaluating: %d / %d' % (vi + 1, len(val_loader)))
-        '''
-        _Fpc, _Fc = eval_mask_boundary(seg_predictions.numpy(), mask.numpy(), args.dataset_cls.num_classes, bound_th=float(thresh))
-        Fc += _Fc
-        Fpc += _Fpc
-        logging.info('F_Score: ' + str(np.sum(Fpc/Fc)/args.dataset_cls.num_classes))
-        '''
-  
-        IOU_acc += fast_hist(seg_predictions.numpy().flatten(), mask.numpy().flatten(),
-                             args.dataset_cls.num_classes)
+        if args.fscore:
+            _Fpc, _Fc = eval_mask_boundary(seg_predictions.numpy(), mask.numpy(), args.dataset_cls.num_classes, bound_th=float(thresh))
+            Fc += _Fc
+            Fpc += _Fpc
+            logging.info('F_Score: ' + str(np.sum(Fpc/Fc)/args.dataset_cls.num_classes))
+
+        for i in range(len(img_names)):
+            hists[img_names[i]] = fast_hist(seg_predictions[i].numpy().flatten(), mask[i].numpy().flatten(),
+                                            args.dataset_cls.num_classes)
 
         del seg_out, edge_out, vi, data
 
-    
+    return hists, Fpc, Fc
+
+
+def get_measures(IOU_acc):
+    '''
+    Returns the measures of the summed confusion histogram IOU_acc
+    '''
     acc = np.diag(IOU_acc).sum() / IOU_acc.sum()
     acc_cls = np.diag(IOU_acc) / IOU_acc.sum(axis=1)
     acc_cls = np.nanmean(acc_cls)
@@ -206,8 +337,6 @@ def evaluate(val_loader, net):
     mean_iu = np.nanmean(iu)
     fwavacc = (freq[freq > 0] * iu[freq > 0]).sum()
 
-    #logging.info('F_Score: ' + str(np.sum(Fpc/Fc)/args.dataset_cls.num_classes))
-    #logging.info('F_Score (Classwise): ' + str(Fpc/Fc))
     results ={
         "mean_iu": mean_iu,
         "acc": acc,
@@ -218,8 +347,8 @@ def evaluate(val_loader, net):
     return results
 
 
-def restore_snapshot(net):
-    checkpoint = torch.load(args.snapshot, map_location=torch.device('cpu'))
+def restore_snapshot(net, snapshot):
+    checkpoint = torch.load(snapshot, map_location=torch.device('cpu'))
     logging.info("Load Compelete")
     if 'state_dict' in checkpoint:
         net = forgiving_state_restore(net, checkpoint['state_dict'])
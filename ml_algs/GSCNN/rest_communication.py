@@ -1,8 +1,8 @@
 # By: Oscar Andersson 2019
 
-from flask import Flask, abort
-import json
-from eval import main as run_eval
+from flask import Flask, abort, request
+import json, os
+from eval import Evaluator
 import sys
 
 import time
@@ -13,6 +13,12 @@ eval_calls = 0
 
 app = Flask(__name__)
 
+# Evaluation directories of requests are relative to the shared data volume
+DATA_BASE = "/data/"
+
+# The network is restored once and kept resident between requests
+evaluator = Evaluator()
+
 @app.route('/')
 def index():
     time_since = str(int(round(time.time() - last_request)))
@@ -23,6 +29,15 @@ def index():
             " seconds<br>Number of eval-calls: " + str(eval_calls) +
             "<br>Mean call time: " + str(mean_call_time) + " seconds")
 
+@app.route('/model', methods=['GET'])
+def get_model():
+    # Clients key cached results by the checkpoint
+    return app.response_class(
+        status=200,
+        response=json.dumps({"model_id": evaluator.model_id}),
+        mimetype='application/json'
+    )
+
 @app.route('/eval', methods=['GET'])
 def get_eval_results():
     global last_request, eval_calls
@@ -30,7 +45,11 @@ def get_eval_results():
 
     last_request = time.time()
     eval_calls += 1
-    eval_results = run_eval()
+    eval_dir = request.args.get('eval_dir')
+    eval_root = None
+    if(eval_dir != None):
+        eval_root = os.path.join(DATA_BASE, eval_dir)
+    eval_results = evaluator.evaluate(eval_root)
     
     try:
         res = app.response_class(
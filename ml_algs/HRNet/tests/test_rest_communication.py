@@ -0,0 +1,74 @@
+# By: Oscar Andersson 2019
+
+import os, sys, types, importlib, tracemalloc
+import pytest
+
+flask = pytest.importorskip("flask")
+
+TOOLS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tools")
+NO_REQUESTS = 5000
+
+
+class StubEvaluator:
+    '''
+    Replaces the Evaluator of tools/test.py, records the arguments of the
+    server and the overrides of every evaluation instead of running the model
+    '''
+
+    def __init__(self, command_args, hist_cache_path=None, batch_size=1, fp16=False):
+        self.model_id = "checkpoint-digest"
+        self.command_args = command_args
+        self.initial_args = list(command_args)
+        self.override_lengths = set()
+
+    def evaluate(self, overrides=()):
+        self.override_lengths.add(len(overrides))
+        return {"mean_IoU": 0.5, "pixel_acc": 0.9, "mean_acc": 0.6, "images_per_second": 1.0}
+
+
+@pytest.fixture
+def rest_com(monkeypatch):
+    '''
+    Imports tools/rest_communication.py with the stubbed Evaluator
+    '''
+    stub_test = types.ModuleType("test")
+    stub_test.Evaluator = StubEvaluator
+    monkeypatch.setitem(sys.modules, "test", stub_test)
+    monkeypatch.syspath_prepend(TOOLS_DIR)
+    sys.modules.pop("rest_communication", None)
+    module = importlib.import_module("rest_communication")
+    yield module
+    sys.modules.pop("rest_communication", None)
+
+
+def test_repeated_requests_do_not_accumulate_arguments(rest_com):
+    client = rest_com.app.test_client()
+    base_args = tuple(rest_com.BASE_COMMAND_ARGS)
+    query = {"eval_list": "val", "eval_dir": "eval-pool/hrnet/0"}
+
+    # Warm up Flask and the allocator before measuring
+    for _ in range(100):
+        assert client.get("/eval", query_string=query).status_code == 200
+
+    tracemalloc.start()
+    start_memory, _ = tracemalloc.get_traced_memory()
+    for i in range(NO_REQUESTS):
+        response = client.get("/eval", query_string=query if i % 2 else {})
+        assert response.status_code == 200
+    end_memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Base arguments are never extended and every request has overrides of its own
+    assert tuple(rest_com.BASE_COMMAND_ARGS) == base_args
+    assert rest_com.evaluator.command_args == rest_com.evaluator.initial_args
+    assert rest_com.evaluator.override_lengths == {0, 4}
+    assert len(rest_com.get_overrides("val", "eval-pool/hrnet/0")) == 4
+
+    # Memory must not grow with the number of requests
+    assert end_memory - start_memory < 512 * 1024
+
+
+def test_model_reports_checkpoint(rest_com):
+    response = rest_com.app.test_client().get("/model")
+    assert response.status_code == 200
+    assert response.get_json() == {"model_id": "checkpoint-digest"}
@@ -0,0 +1,97 @@
+# ------------------------------------------------------------------------------
+# Per-image confusion histograms of evaluations.
+# Written by Oscar Andersson
+# ------------------------------------------------------------------------------
+
+import os
+import json
+import hashlib
+import sqlite3
+import numpy as np
+
+
+class HistCache(object):
+    '''
+    Keeps the confusion histogram of every evaluated image in an SQLite
+    database. Histograms are keyed by the content of the image, its mask,
+    the model which made the prediction and the settings of the inference,
+    so only images which changed since an earlier evaluation with the same
+    settings have to be inferred again.
+    '''
+
+    def __init__(self, cache_path, model_file, num_classes):
+        self.cache_path = cache_path
+        self.num_classes = num_classes
+        # A new checkpoint invalidates every histogram of the old one
+        stat = os.stat(model_file)
+        self.model_id = json.dumps([os.path.abspath(model_file), stat.st_size, stat.st_mtime, num_classes])
+
+        cache_dir = os.path.dirname(cache_path)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        connection = self.get_connection()
+        try:
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS hists (key TEXT PRIMARY KEY, hist BLOB)")
+        finally:
+            connection.close()
+
+    def get_connection(self):
+        return sqlite3.connect(self.cache_path, timeout=60)
+
+    def get_key(self, img_bytes, mask_path, settings=None):
+        '''
+        Returns the key of the histogram of an image with content img_bytes
+        and ground truth mask_path, inferred under settings. settings, a JSON
+        serialisable object, holds everything besides the checkpoint which
+        affects the prediction (scales, precision, batching...)
+        '''
+        key = hashlib.sha256()
+        key.update(json.dumps([self.model_id, mask_path, settings], sort_keys=True).encode('utf8'))
+        key.update(img_bytes)
+        return key.hexdigest()
+
+    def lookup(self, keys):
+        '''
+        Returns the cached histograms of keys, by key
+        '''
+        hists = {}
+        connection = self.get_connection()
+        try:
+            for key in set(keys):
+                row = connection.execute("SELECT hist FROM hists WHERE key = ?", (key,)).fetchone()
+                if row != None:
+                    hists[key] = np.frombuffer(row[0], dtype=np.int64).reshape(
+                        self.num_classes, self.num_classes)
+        finally:
+            connection.close()
+        return hists
+
+    def store(self, hists):
+        '''
+        Stores histograms, given by key
+        '''
+        connection = self.get_connection()
+        try:
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO hists VALUES (?, ?)",
+                                       [(key, sqlite3.Binary(np.asarray(hist, dtype=np.int64).tobytes()))
+                                        for key, hist in hists.items()])
+        finally:
+            connection.close()
+
+
+def read_image_bytes(img_path):
+    with open(img_path, 'rb') as img_file:
+        return img_file.read()
+
+
+def get_file_digest(file_path):
+    '''
+    Returns the SHA-256 digest of the content of a file, e.g. a checkpoint
+    '''
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
@@ -1,8 +1,8 @@
 # By: Oscar Andersson 2019
 
 from flask import Flask, abort, request
-import json
-from test import main as run_eval
+import json, os
+from test import Evaluator
 import sys
 
 import time
@@ -24,13 +24,46 @@ def index():
             "<br>Mean call time: " + str(mean_call_time) + " seconds")
 
 
-command_args = []
-command_args.append("--cfg")
-command_args.append("experiments/cityscapes/seg_hrnet_ocr_w48_train_oscar.yaml")
-command_args.append("DATASET.ROOT")
-command_args.append("/data/HRNet-mldata/")
-command_args.append("TEST.MODEL_FILE")
-command_args.append("models/hrnet_ocr_cs_8162_torch11.pth")
+# Base configuration of every evaluation, requests only add overrides to it
+BASE_COMMAND_ARGS = (
+    "--cfg", "experiments/cityscapes/seg_hrnet_ocr_w48_train_oscar.yaml",
+    "DATASET.ROOT", "/data/HRNet-mldata/",
+    "DATASET.TEST_SET", "list/cityscapes/val.lst",
+    "TEST.MODEL_FILE", "models/hrnet_ocr_cs_8162_torch11.pth",
+)
+
+# Images inferred per forward pass and whether to infer in half precision
+EVAL_BATCH_SIZE = 2
+EVAL_FP16 = False
+
+# The model is loaded once and kept resident between requests
+evaluator = Evaluator(list(BASE_COMMAND_ARGS), "/data/HRNet-mldata/hist-cache.sqlite",
+                      batch_size=EVAL_BATCH_SIZE, fp16=EVAL_FP16)
+
+# Evaluation directories of requests are relative to the shared data volume
+DATA_BASE = "/data/"
+
+
+def get_overrides(eval_list=None, eval_dir=None):
+    '''
+    Returns the config options which a request changes in the base configuration
+    '''
+    overrides = []
+    if(eval_dir != None):
+        overrides += ["DATASET.ROOT", os.path.join(DATA_BASE, eval_dir) + "/"]
+    if(eval_list != None):
+        overrides += ["DATASET.TEST_SET", "list/cityscape_eval/"+ str(eval_list) +".lst"]
+    return overrides
+
+
+@app.route('/model', methods=['GET'])
+def get_model():
+    # Clients key cached results by the checkpoint
+    return app.response_class(
+        status=200,
+        response=json.dumps({"model_id": evaluator.model_id}),
+        mimetype='application/json'
+    )
 
 
 @app.route('/eval', methods=['GET'])
@@ -40,15 +73,8 @@ def get_eval_results():
 
     last_request = time.time()
     eval_calls += 1
-    eval_list = request.args.get('eval_list')
-    command = command_args
-    command.append("DATASET.TEST_SET")
-    if(eval_list != None):
-        command.append("list/cityscape_eval/"+ str(eval_list) +".lst")
-    else:
-        command.append("list/cityscapes/val.lst")
-    
-    eval_results = run_eval(command)
+    overrides = get_overrides(request.args.get('eval_list'), request.args.get('eval_dir'))
+    eval_results = evaluator.evaluate(overrides)
     
     try:
         res = app.response_class(
@@ -14,6 +14,7 @@ import sys
 import logging
 import time
 import timeit
+from functools import partial
 from pathlib import Path
 
 import numpy as np
@@ -21,15 +22,17 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.backends.cudnn as cudnn
+import torch.nn.functional as F
 
 import _init_paths
 import models
 import datasets
 from config import config
 from config import update_config
-from core.function import testval, test
+from core.function import test
 from utils.modelsummary import get_model_summary
-from utils.utils import create_logger, FullModel
+from utils.utils import create_logger, FullModel, get_confusion_matrix
+from hist_cache import HistCache, read_image_bytes, get_file_digest
 
 def parse_args(command_args):
     parser = argparse.ArgumentParser(description='Train segmentation network')
@@ -48,83 +51,249 @@ def parse_args(command_args):
 
     return args
 
+class AutocastModule(nn.Module):
+    '''
+    Runs the forward pass of a model under autocast half precision.
+    autocast is thread local and DataParallel runs every replica in a thread
+    of its own, so the replicas must enter autocast themselves
+    '''
+
+    def __init__(self, model):
+        super(AutocastModule, self).__init__()
+        self.model = model
+
+    def forward(self, *args, **kwargs):
+        with torch.cuda.amp.autocast():
+            return self.model(*args, **kwargs)
+
+class Evaluator(object):
+    '''
+    Keeps the configuration and the model resident between evaluations,
+    an evaluation then only builds the dataset and runs inference.
+    Runs on the GPUs of the configuration, or on the CPU if CUDA is unavailable.
+    Images are inferred batch_size at a time, under autocast half precision
+    if fp16 is set and the model runs on CUDA.
+    '''
+
+    def __init__(self, command_args, hist_cache_path=None, batch_size=1, fp16=False):
+        parse_args(command_args)
+        # Requests configure clones of the base configuration, never the base itself
+        self.base_config = config.clone()
+        self.base_config.freeze()
+
+        # cudnn related setting
+        cudnn.benchmark = config.CUDNN.BENCHMARK
+        cudnn.deterministic = config.CUDNN.DETERMINISTIC
+        cudnn.enabled = config.CUDNN.ENABLED
+
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.batch_size = batch_size
+        self.fp16 = fp16 and self.device.type == 'cuda' and hasattr(torch.cuda, 'amp')
+        if fp16 and not self.fp16:
+            print("Half precision needs CUDA and torch.cuda.amp, running in full precision")
+        self.model = self.build_model()
+        # Identifies the checkpoint to clients which cache results
+        self.model_id = get_file_digest(self.get_model_file())
+
+        # Per-image histograms, only images which changed are inferred again
+        self.hist_cache = None
+        if hist_cache_path:
+            self.hist_cache = HistCache(hist_cache_path, self.get_model_file(), config.DATASET.NUM_CLASSES)
+
+    def get_model_file(self):
+        if config.TEST.MODEL_FILE:
+            return config.TEST.MODEL_FILE
+        return os.path.join(final_output_dir, 'best.pth')
+
+    def build_model(self):
+        # build model
+        if torch.__version__.startswith('1'):
+            module = eval('models.'+config.MODEL.NAME)
+            module.BatchNorm2d_class = module.BatchNorm2d = torch.nn.BatchNorm2d
+        model = eval('models.'+config.MODEL.NAME +
+                     '.get_seg_model')(config)
+
+        pretrained_dict = torch.load(self.get_model_file(), map_location='cpu')
+        model_dict = model.state_dict()
+        #assert set(k[6:] for k in pretrained_dict) == set(model_dict)
+        pretrained_dict = {k[6:]: v for k, v in pretrained_dict.items()
+                            if k[6:] in model_dict.keys()}
+
+        model_dict.update(pretrained_dict)
+        model.load_state_dict(model_dict)
+
+        if self.device.type == 'cuda':
+            gpus = list(config.GPUS)
+            if self.fp16: model = AutocastModule(model)
+            model = nn.DataParallel(model, device_ids=gpus).cuda()
+        model.eval()
+        return model
+
+    def evaluate(self, overrides=()):
+        '''
+        Evaluates the model on the dataset of the base configuration, where
+        overrides are config options as on the command-line
+        '''
+        config = self.base_config.clone()
+        config.defrost()
+        config.merge_from_list(list(overrides))
+        config.freeze()
+
+        if 'test' in config.DATASET.TEST_SET:
+            print("Cannot extract accuracy from test-sets")
+            exit(1)
+
+        # prepare data
+        test_size = (config.TEST.IMAGE_SIZE[1], config.TEST.IMAGE_SIZE[0])
+        test_dataset = eval('datasets.'+config.DATASET.DATASET)(
+                            root=config.DATASET.ROOT,
+                            list_path=config.DATASET.TEST_SET,
+                            num_samples=None,
+                            num_classes=config.DATASET.NUM_CLASSES,
+                            multi_scale=False,
+                            flip=False,
+                            ignore_label=config.TRAIN.IGNORE_LABEL,
+                            base_size=config.TEST.BASE_SIZE,
+                            crop_size=test_size,
+                            downsample_rate=1)
+
+        # Only inference is timed, reading, hashing and looking up cached images is not
+        inferred_images, inference_time = 0, 0.
+        if self.hist_cache == None:
+            start_time = time.time()
+            hists = self.infer_histograms(config, test_dataset)
+            inference_time = time.time() - start_time
+            inferred_images = len(hists)
+            confusion_matrix = sum(hists.values())
+        else:
+            keys = {}
+            settings = self.get_inference_settings(config)
+            for item in test_dataset.files:
+                img_bytes = read_image_bytes(os.path.join(config.DATASET.ROOT, 'cityscapes', item["img"]))
+                keys[item["name"]] = self.hist_cache.get_key(img_bytes, item["label"], settings)
+            hists = self.hist_cache.lookup(keys.values())
+
+            uncached = [item for item in test_dataset.files if keys[item["name"]] not in hists]
+            print("Cached histograms: " + str(len(test_dataset.files) - len(uncached)) +
+                  ", images to infer: " + str(len(uncached)))
+            if len(uncached) > 0:
+                test_dataset.files = uncached
+                start_time = time.time()
+                inferred = self.infer_histograms(config, test_dataset)
+                inference_time = time.time() - start_time
+                inferred_images = len(inferred)
+                inferred = {keys[name]: hist for name, hist in inferred.items()}
+                self.hist_cache.store(inferred)
+                hists.update(inferred)
+            confusion_matrix = sum(hists[key] for key in keys.values())
+
+        mean_IoU, _, pixel_acc, mean_acc = get_measures(confusion_matrix)
+
+        results = {}
+        results["mean_IoU"] = mean_IoU
+        results["pixel_acc"] = pixel_acc,
+        results["mean_acc"] = mean_acc
+        # None if every histogram was cached
+        results["images_per_second"] = inferred_images / inference_time if inferred_images > 0 else None
+
+        return results
+
+    def get_inference_settings(self, config):
+        '''
+        Returns the settings of a request, after its overrides, which affect
+        the predictions. Histograms inferred under other settings are not reused
+        '''
+        return {"TEST": config.TEST, "MODEL": config.MODEL, "IGNORE_LABEL": config.TRAIN.IGNORE_LABEL,
+                "fp16": self.fp16, "batch_size": self.batch_size}
+
+    def infer_histograms(self, config, test_dataset):
+        '''
+        Version of core.function.testval which runs on the device of the
+        model. Returns the confusion matrix of every image, by name.
+        Single scale inference without flipping is batched, TEST.SCALE_LIST
+        and TEST.FLIP_TEST infer one image at a time as testval does
+        '''
+        scales = [float(scale) for scale in config.TEST.SCALE_LIST]
+        flip = config.TEST.FLIP_TEST
+        single_scale = scales == [1.0] and not flip
+        testloader = torch.utils.data.DataLoader(
+            test_dataset,
+            batch_size=self.batch_size if single_scale else 1,
+            shuffle=False,
+            num_workers=config.WORKERS,
+            pin_memory=self.device.type == 'cuda',
+            collate_fn=partial(pad_collate, ignore_label=config.TRAIN.IGNORE_LABEL))
+
+        hists = {}
+        # inference_mode is cheaper than no_grad where available
+        with getattr(torch, 'inference_mode', torch.no_grad)():
+            for image, label, _, name in testloader:
+                size = label.size()
+                # Flipped and rescaled images are prepared on the CPU by the dataset
+                if single_scale: image = image.to(self.device)
+                # The model runs under autocast on every GPU (AutocastModule)
+                pred = self.infer(config, test_dataset, image, scales, flip)
+                if self.fp16: pred = pred.float()
+
+                if pred.size()[-2] != size[-2] or pred.size()[-1] != size[-1]:
+                    pred = F.interpolate(
+                        pred, size[-2:],
+                        mode='bilinear', align_corners=config.MODEL.ALIGN_CORNERS
+                    )
+
+                for i in range(len(name)):
+                    hists[name[i]] = get_confusion_matrix(
+                        label[i:i+1],
+                        pred[i:i+1],
+                        size,
+                        config.DATASET.NUM_CLASSES,
+                        config.TRAIN.IGNORE_LABEL)
+
+        return hists
+
+    def infer(self, config, test_dataset, image, scales, flip):
+        if scales == [1.0]:
+            return test_dataset.inference(config, self.model, image, flip=flip)
+        return test_dataset.multi_scale_inference(config, self.model, image, scales=scales, flip=flip)
+
+
+def pad_collate(batch, ignore_label):
+    '''
+    Collates test samples of different sizes by padding them to the largest
+    one. Padded label pixels are ignored, so they never count as predictions.
+    '''
+    height = max(image.shape[-2] for image, _, _, _ in batch)
+    width = max(image.shape[-1] for image, _, _, _ in batch)
+
+    images = np.zeros((len(batch), 3, height, width), dtype=np.float32)
+    labels = np.full((len(batch), height, width), ignore_label, dtype=np.int64)
+    for i, (image, label, _, _) in enumerate(batch):
+        images[i, :, :image.shape[-2], :image.shape[-1]] = image
+        labels[i, :label.shape[-2], :label.shape[-1]] = label
+
+    sizes = torch.from_numpy(np.stack([np.array(size) for _, _, size, _ in batch]))
+    names = [name for _, _, _, name in batch]
+    return torch.from_numpy(images), torch.from_numpy(labels), sizes, names
+
+
+def get_measures(confusion_matrix):
+    '''
+    Returns the measures of core.function.testval from a confusion matrix
+    '''
+    pos = confusion_matrix.sum(1)
+    res = confusion_matrix.sum(0)
+    tp = np.diag(confusion_matrix)
+    pixel_acc = tp.sum()/pos.sum()
+    mean_acc = (tp/np.maximum(1.0, pos)).mean()
+    IoU_array = (tp / np.maximum(1.0, pos + res - tp))
+    mean_IoU = IoU_array.mean()
+
+    return mean_IoU, IoU_array, pixel_acc, mean_acc
+
+
 def main(command_args):
-    
-    parse_args(command_args)
-
-    # cudnn related setting
-    cudnn.benchmark = config.CUDNN.BENCHMARK
-    cudnn.deterministic = config.CUDNN.DETERMINISTIC
-    cudnn.enabled = config.CUDNN.ENABLED
-
-    # build model
-    if torch.__version__.startswith('1'):
-        module = eval('models.'+config.MODEL.NAME)
-        module.BatchNorm2d_class = module.BatchNorm2d = torch.nn.BatchNorm2d
-    model = eval('models.'+config.MODEL.NAME +
-                 '.get_seg_model')(config)
-
-    dump_input = torch.rand(
-        (1, 3, config.TEST.IMAGE_SIZE[1], config.TEST.IMAGE_SIZE[0])
-    )
-
-    if config.TEST.MODEL_FILE:
-        model_state_file = config.TEST.MODEL_FILE
-    else:
-        model_state_file = os.path.join(final_output_dir,
-                                        'best.pth')
-    
-    pretrained_dict = torch.load(model_state_file)
-    model_dict = model.state_dict()
-    #assert set(k[6:] for k in pretrained_dict) == set(model_dict)
-    pretrained_dict = {k[6:]: v for k, v in pretrained_dict.items()
-                        if k[6:] in model_dict.keys()}
-
-    model_dict.update(pretrained_dict)
-    model.load_state_dict(model_dict)
-
-    gpus = list(config.GPUS)
-    model = nn.DataParallel(model, device_ids=gpus).cuda()
-
-
-    # prepare data
-    test_size = (config.TEST.IMAGE_SIZE[1], config.TEST.IMAGE_SIZE[0])
-    test_dataset = eval('datasets.'+config.DATASET.DATASET)(
-                        root=config.DATASET.ROOT,
-                        list_path=config.DATASET.TEST_SET,
-                        num_samples=None,
-                        num_classes=config.DATASET.NUM_CLASSES,
-                        multi_scale=False,
-                        flip=False,
-                        ignore_label=config.TRAIN.IGNORE_LABEL,
-                        base_size=config.TEST.BASE_SIZE,
-                        crop_size=test_size,
-                        downsample_rate=1)
-
-    testloader = torch.utils.data.DataLoader(
-        test_dataset,
-        batch_size=1,
-        shuffle=False,
-        num_workers=config.WORKERS,
-        pin_memory=True)
-    
-    
-    # Define results to be returned
-    mean_IoU, pixel_acc, mean_acc = 0.,0.,0.,
-
-    if 'val' in config.DATASET.TEST_SET:
-        mean_IoU, _, pixel_acc, mean_acc = testval(config, test_dataset, testloader, model)
-    elif 'test' in config.DATASET.TEST_SET:
-        print("Cannot extract accuracy from test-sets")
-        exit(1)
-
-    results = {}
-    results["mean_IoU"] = mean_IoU
-    results["pixel_acc"] = pixel_acc,
-    results["mean_acc"] = mean_acc
-    
-    return results
+    return Evaluator(command_args).evaluate()
 
 
 if __name__ == '__main__':
-    main()
+    main(sys.argv[1:])
@@ -3,35 +3,46 @@
 # Imports
 import pygmo as pyg
 import numpy as np
-import random, logging, os, argparse, csv, pickle
+import random, logging, os, argparse, csv, pickle, copy
 from datetime import datetime
 
 # Import modules
 import config.config as cfg
 import utils.plotting as pl
+import utils.surrogate as surrogate
 from optimization_problem import sweetspot_problem
+from utils.enc_arg_parser import get_codec_args_key
 
 
-def get_optimization_algorithm(randseed):
+def get_optimization_algorithm(randseed, mog_alg=None):
     '''
-    Returns an optimisation algorithm
+    Returns an optimisation algorithm, MOG_ALG if mog_alg is not given
     '''
-    opt_alg = None
-    if(cfg.MOG_ALG == "nsga2"):
+    if mog_alg is None: mog_alg = cfg.MOG_ALG
+    uda = None
+    if(mog_alg == "nsga2"):
         # cr: crossover probability, m: mutation probability
         # eta_c: distribution index for crossover, eta_m: distribution index for mutation
-        opt_alg = pyg.algorithm( pyg.nsga2(gen=1, cr=0.925, m=0.05,
-                                           eta_c=10, eta_m=50, seed=randseed) )
-    elif(cfg.MOG_ALG == "moead"):
-        opt_alg = pyg.algorithm ( pyg.moead(gen = 1, weight_generation = "grid",
-                                            decomposition = "tchebycheff", neighbours = 5,
-                                            CR = 1, F = 0.5, eta_m = 20, realb = 0.9,
-                                            limit = 2, preserve_diversity = True) )
-    elif(cfg.MOG_ALG == "nspso"):
-        opt_alg = pyg.algorithm ( pyg.nspso(gen = 1, omega = 0.6, c1 = 0.01, c2 = 0.5, chi = 0.5,
-                                            v_coeff = 0.5, leader_selection_range = 2,
-                                            diversity_mechanism = "crowding distance",
-                                            memory = False) )
+        uda = pyg.nsga2(gen=1, cr=0.925, m=0.05,
+                        eta_c=10, eta_m=50, seed=randseed)
+    elif(mog_alg == "moead"):
+        uda = pyg.moead(gen = 1, weight_generation = "grid",
+                        decomposition = "tchebycheff", neighbours = 5,
+                        CR = 1, F = 0.5, eta_m = 20, realb = 0.9,
+                        limit = 2, preserve_diversity = True)
+    elif(mog_alg == "nspso"):
+        uda = pyg.nspso(gen = 1, omega = 0.6, c1 = 0.01, c2 = 0.5, chi = 0.5,
+                        v_coeff = 0.5, leader_selection_range = 2,
+                        diversity_mechanism = "crowding distance",
+                        memory = False)
+
+    # Evaluate every generation as one batch (sweetspot_problem.batch_fitness)
+    # if the algorithm supports batch fitness evaluators
+    if hasattr(uda, "set_bfe"):
+        logger.debug("Using batch fitness evaluation for " + mog_alg)
+        uda.set_bfe(pyg.bfe(pyg.member_bfe()))
+
+    opt_alg = pyg.algorithm(uda)
     opt_alg.set_verbosity(1)
     return opt_alg
 
@@ -67,14 +78,113 @@ def uniform_init(prob, pop):
     decision_vectors = np.transpose(decision_vectors)
     logger.debug("Initial decision vectors:\n" + str(decision_vectors))
 
-    # Add decision vectors to population
-    for d_vector in decision_vectors:
+    # Evaluate the initial population as one batch, then add it with its fitness
+    fitnesses = pyg.bfe(pyg.member_bfe())(pop.problem, decision_vectors.flatten()).reshape(len(decision_vectors), -1)
+    for d_vector, f in zip(decision_vectors, fitnesses):
         logger.debug("Pushing chromosome: " + str(d_vector))
-        pop.push_back(d_vector)
+        pop.push_back(d_vector, f)
     return pop
 
 
 
+def evolve_generation(opt_alg, pop):
+    '''
+    Evolves pop one generation, assisted by the surrogate if SURROGATE_MODE is set
+    '''
+    if cfg.SURROGATE_MODE: return surrogate_evolve(opt_alg, pop)
+    return opt_alg.evolve(pop)
+
+
+def surrogate_evolve(opt_alg, pop):
+    '''
+    Evolves pop one generation with a surrogate of the fitness function.
+    Offspring are bred by opt_alg for SURROGATE_OVERSAMPLING generations on the
+    surrogate, the POP_SIZE most promising by predicted non-domination are
+    evaluated and compete with pop for survival.
+    Falls back to opt_alg.evolve if the history is too small or the
+    predictions too uncertain.
+    '''
+    X, F = surrogate.load_history(cfg.RESULTS_PATH)
+    if len(X) < cfg.SURROGATE_MIN_HISTORY:
+        logger.info("Surrogate history too small (" + str(len(X)) + " evaluations), evolving without surrogate")
+        return opt_alg.evolve(pop)
+    model = surrogate.fitness_surrogate(X, F)
+
+    # Breed candidates on the surrogate, starting from the evaluated population
+    s_pop = pyg.population(pyg.problem(surrogate.surrogate_problem(model)))
+    for x, f in zip(pop.get_x(), surrogate.to_model_space(pop.get_f())):
+        s_pop.push_back(x, f)
+    evaluated = pop.problem.extract(sweetspot_problem).fitness_dict
+    candidates = {}
+    for _ in range(cfg.SURROGATE_OVERSAMPLING):
+        s_pop = opt_alg.evolve(s_pop)
+        for x in s_pop.get_x():
+            args_key = get_codec_args_key(x)
+            if args_key not in evaluated and args_key not in candidates: candidates[args_key] = x
+
+    if len(candidates) < len(pop):
+        logger.info("Surrogate bred " + str(len(candidates)) + " new chromosomes, evolving without surrogate")
+        return opt_alg.evolve(pop)
+
+    # Rank candidates together with the population by predicted non-domination and crowding
+    cand_x = np.array(list(candidates.values()))
+    mean, std = model.predict(cand_x)
+    order = pyg.sort_population_mo(np.vstack((surrogate.to_model_space(pop.get_f()), mean)))
+    selected = [i-len(pop) for i in order if i >= len(pop)][:len(pop)]
+
+    uncertainty = np.max(np.mean(std[selected], axis=0))
+    logger.info("Surrogate selected " + str(len(selected)) + " of " + str(len(cand_x)) +
+                " chromosomes, predictive std: " + str(round(uncertainty, 3)))
+    if uncertainty > cfg.SURROGATE_MAX_STD:
+        logger.info("Surrogate too uncertain, evolving without surrogate")
+        return opt_alg.evolve(pop)
+
+    # Evaluate the selected offspring as one batch and keep the best of parents and offspring
+    offspring_x = cand_x[selected]
+    offspring_f = pyg.bfe(pyg.member_bfe())(pop.problem, offspring_x.flatten()).reshape(len(selected), -1)
+    all_x = np.vstack((pop.get_x(), offspring_x))
+    all_f = np.vstack((pop.get_f(), offspring_f))
+    for i, best in enumerate(pyg.select_best_N_mo(all_f, len(pop))):
+        pop.set_xf(i, all_x[best], all_f[best])
+    return pop
+
+
+def get_archipelago(opt_prob, rand_seed):
+    '''
+    Returns an archipelago with an island for every algorithm of ARCHIPELAGO_ALGS.
+    Islands are evolved in processes of their own (mp_island) and form a
+    ring topology, which migrates the best individuals of an island to its
+    neighbour with probability ARCHIPELAGO_MIGRATION_RATE every generation
+    '''
+    archi = pyg.archipelago(t=pyg.ring(w=cfg.ARCHIPELAGO_MIGRATION_RATE))
+    udp = opt_prob.extract(sweetspot_problem)
+    mog_alg = cfg.MOG_ALG
+    for island, island_alg in enumerate(cfg.ARCHIPELAGO_ALGS):
+        logger.info("Initiating island " + str(island) + " evolved by " + island_alg)
+        cfg.MOG_ALG = island_alg
+        island_udp = copy.deepcopy(udp)
+        island_udp.island = island
+        island_udp.run_state = cfg.get_run_state()
+        island_prob = pyg.problem(island_udp)
+
+        pop = pyg.population(prob=island_prob, seed=rand_seed+island)
+        pop = uniform_init(island_prob, pop)
+        archi.push_back(udi=pyg.mp_island(), algo=get_optimization_algorithm(rand_seed+island, island_alg), pop=pop)
+    cfg.MOG_ALG = mog_alg
+    return archi
+
+
+def evolve_archipelago(archi, base_gen=0):
+    '''
+    Evolves all islands of archi in parallel, one generation at a time
+    '''
+    for gen in range(base_gen, cfg.NO_GENERATIONS):
+        logger.info("Generation: " + str(gen+1))
+        archi.evolve()
+        archi.wait_check()
+        pickle.dump( archi, open( cfg.POPULATION_PICKLE_PATH, "wb" ) )
+
+
 def sweetspot_search(codec_arg, rate_control_arg, moga_arg):
     '''
     Evolves a population with a given optimization algorithm
@@ -105,6 +215,9 @@ def sweetspot_search(codec_arg, rate_control_arg, moga_arg):
                 # Initiate population
                 rand_seed = cfg.get_random_seed(epoch)
                 random.seed(rand_seed)
+                if cfg.ARCHIPELAGO_MODE:
+                    evolve_archipelago(get_archipelago(opt_prob, rand_seed))
+                    continue
                 pop = pyg.population(prob=opt_prob, seed=rand_seed)
                 pop = uniform_init(opt_prob, pop)
 
@@ -115,7 +228,7 @@ def sweetspot_search(codec_arg, rate_control_arg, moga_arg):
                 logger.debug("Starting evolution process")
                 for gen in range(0, cfg.NO_GENERATIONS):
                     logger.info("Generation: " + str(gen+1))
-                    pop = opt_alg.evolve(pop)
+                    pop = evolve_generation(opt_alg, pop)
                     pickle.dump( pop, open( cfg.POPULATION_PICKLE_PATH, "wb" ) )                    
 
 
@@ -141,6 +254,11 @@ def resume_optimisation(codec, rate_control, moga, base_gen, epoch):
     pop = pickle.load( open( cfg.POPULATION_PICKLE_PATH, "rb" ) )
     logger.info(pop)
 
+    # Archipelagos are pickled as a whole
+    if isinstance(pop, pyg.archipelago):
+        evolve_archipelago(pop, base_gen)
+        return
+
     # Set up optimization algorithm
     opt_alg = get_optimization_algorithm(rand_seed)
 
@@ -148,7 +266,7 @@ def resume_optimisation(codec, rate_control, moga, base_gen, epoch):
     logger.debug("Starting evolution process")
     for gen in range(base_gen, cfg.NO_GENERATIONS):
         logger.info("Generation: " + str(gen+1))
-        pop = opt_alg.evolve(pop)
+        pop = evolve_generation(opt_alg, pop)
         pickle.dump( pop, open( cfg.POPULATION_PICKLE_PATH, "wb" ) )                    
 
 
@@ -168,9 +286,14 @@ if(__name__ == "__main__"):
     parser.add_argument('-r', '--resume', action="store_true", help="Resume optimisation using pickle-file")
     parser.add_argument('-rg', '--rgen', type=int, default=None, help="Number of generations already evolved")
     parser.add_argument('-re', '--repoch', type=int, default=1, help="Epoch number of resumption")
+    parser.add_argument('-s', '--surrogate', action="store_true", help="Pre-screen offspring with a surrogate of the fitness function")
+    parser.add_argument('-i', '--islands', action="store_true", help="Evolve an archipelago of ARCHIPELAGO_ALGS islands in parallel")
 
 
     args = parser.parse_args()
+    if args.surrogate: cfg.SURROGATE_MODE = True
+    if args.islands: cfg.ARCHIPELAGO_MODE = True
+    cfg.check_config()
 
     if(not args.resume):
         # Start sweetspot search
@@ -3,12 +3,17 @@
 import pygmo as pyg
 import numpy as np
 import os, time, random, csv
-import shutil, logging
+import logging, queue, threading, multiprocessing
 
 import config.config as cfg
 import utils.ffmpeg_utils as ffu # import functions from ffmpeg_utils.py
 import utils.plotting as pl
 import utils.rest_communication as rest_com
+import utils.fitness_cache as fcache
+import utils.output_pool as opool
+import utils.multi_fidelity as mfid
+import utils.job_queue as jq
+from utils.enc_arg_parser import get_codec_args_key
 
 logger = logging.getLogger('gen-alg')
 
@@ -26,6 +31,15 @@ class sweetspot_problem:
     gen = None
     fitness_of_gen = None
     complete_results = None
+    decision_vectors = None
+    dataset_fingerprint = None
+    model_id = None
+    low_fidelity = None
+    rejected = None
+    island = None
+    run_state = None
+    subset_img_size = None
+    subset_fingerprint = None
 
 
     def __init__(self):
@@ -35,10 +49,33 @@ class sweetspot_problem:
         self.gen = 0
         self.fitness_of_gen = []
         self.complete_results = {}
+        self.decision_vectors = {}
         self.original_img_size = ffu.get_directory_size(cfg.ML_DATA_INPUT)
+        self.dataset_fingerprint = fcache.get_dataset_fingerprint(cfg.ML_DATA_INPUT)
+        # Results of other checkpoints of the ML-model are never reused
+        self.model_id = rest_com.get_model_id()
+        if self.model_id is None: logger.warning("Checkpoint of the ML-algorithm unknown, the fitness cache is not used")
+        if cfg.SOURCE_FRAME_CACHE: ffu.cache_sources(cfg.ML_DATA_INPUT)
+
+        # Low-fidelity and early rejected results are kept apart from the full evaluations:
+        # args_key -> (fitness, time, full_response)
+        self.low_fidelity = {}
+        self.rejected = {}
+        if cfg.MULTI_FIDELITY:
+            mfid.write_eval_list(mfid.create_subset(cfg.ML_DATA_INPUT, cfg.MULTI_FIDELITY_INPUT))
+            self.subset_img_size = ffu.get_directory_size(cfg.MULTI_FIDELITY_INPUT)
+            self.subset_fingerprint = fcache.get_dataset_fingerprint(cfg.MULTI_FIDELITY_INPUT)
+            if cfg.SOURCE_FRAME_CACHE: ffu.cache_sources(cfg.MULTI_FIDELITY_INPUT)
+        # The runtime configuration travels with the problem to the processes of archipelago islands
+        self.run_state = cfg.get_run_state()
         logger.debug("Problem initiated")
 
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if multiprocessing.current_process().name != "MainProcess": cfg.restore_run_state(self.run_state)
+
+
     def get_name(self):
         return "Sweetspot problem"
 
@@ -65,61 +102,411 @@ class sweetspot_problem:
         and performance numbers from ml-evaluation.
         Returns the fitness values of x.
         '''
-
+        if cfg.EVAL_BACKEND == "queue": return list(self.batch_fitness(x))
+
+        args_key = self.start_fitness_call(x)
+        if self.lookup_fitness(x, args_key):
+            logger.info("Using previous fitness of identical encoding")
+            self.store_results(x, self.fitness_dict[args_key], self.times[args_key], self.complete_results[args_key])
+            return self.fitness_dict[args_key]
+        if args_key in self.rejected:
+            return self.reject_chromosome(x, self.rejected[args_key])
+
+        # Score x on the subset first, clearly dominated chromosomes keep their low-fidelity fitness
+        if cfg.MULTI_FIDELITY:
+            if not self.lookup_low_fidelity(x, args_key):
+                slot_root, slot_lock = opool.acquire_slot()
+                try:
+                    comp_size, transcode_time, quality = self.transcode_chromosome(
+                        x, opool.get_output_dir(slot_root), self.get_clips(cfg.MULTI_FIDELITY_INPUT), cfg.MULTI_FIDELITY_INPUT)
+                    self.evaluate_low_fidelity(x, args_key, comp_size, transcode_time, opool.get_eval_dir(slot_root), quality)
+                finally:
+                    opool.release_slot(slot_root, slot_lock)
+            if not self.is_promoted(args_key):
+                return self.reject_chromosome(x, self.low_fidelity[args_key])
+
+        # Apply degredation to every clip, in an output directory of its own
+        slot_root, slot_lock = opool.acquire_slot()
+        try:
+            comp_size, transcode_time, quality = self.transcode_chromosome(x, opool.get_output_dir(slot_root), self.get_clips())
+            return self.evaluate_chromosome(x, args_key, comp_size, transcode_time, opool.get_eval_dir(slot_root), quality)
+        finally:
+            opool.release_slot(slot_root, slot_lock)
+
+
+    def batch_fitness(self, dvs):
+        '''
+        Evaluates the fitness of a batch of chromosomes, used by pygmo's
+        batch fitness evaluators (bfe) to score a whole generation at once.
+        dvs contains the decision vectors back to back and the fitness values
+        are returned in the same manner.
+        The next chromosome of the batch is transcoded while the current one
+        is evaluated by the ML-algorithm. In multi-fidelity mode the whole
+        batch is scored on the subset before the promoted chromosomes are
+        evaluated in full. With the queue backend every chromosome is submitted
+        to the job queue at once and evaluated by the workers.
+        '''
+        chromosomes = np.reshape(dvs, (-1, len(cfg.opt_params)))
+        logger.info("Batch evaluation of " + str(len(chromosomes)) + " chromosomes")
+        if cfg.PIPELINE_DEPTH < 1 and cfg.EVAL_BACKEND != "queue":
+            return np.concatenate([self.fitness(x) for x in chromosomes], axis=None)
+
+        # Identical encodings of a batch are only transcoded and evaluated once
+        args_keys = [get_codec_args_key(x) for x in chromosomes]
+        pending = {}
+        for x, args_key in zip(chromosomes, args_keys):
+            if args_key not in pending and args_key not in self.rejected and not self.lookup_fitness(x, args_key):
+                pending[args_key] = x
+        if cfg.MULTI_FIDELITY: pending = self.screen_low_fidelity(pending)
+
+        if cfg.EVAL_BACKEND == "queue":
+            job_ids = {args_key: jq.submit(x) for args_key, x in pending.items()}
+        else:
+            transcoded, stop = self.start_transcode_pipeline(list(pending.values()), self.get_clips())
+
+        try:
+            batch_fits = []
+            for x, args_key in zip(chromosomes, args_keys):
+                self.start_fitness_call(x)
+                if args_key in self.fitness_dict:
+                    logger.info("Using previous fitness of identical encoding")
+                    self.store_results(x, self.fitness_dict[args_key], self.times[args_key], self.complete_results[args_key])
+                    batch_fits.append(self.fitness_dict[args_key])
+                    continue
+                if args_key in self.rejected:
+                    batch_fits.append(self.reject_chromosome(x, self.rejected[args_key]))
+                    continue
+                if args_key not in pending:
+                    batch_fits.append(self.reject_chromosome(x, self.low_fidelity[args_key]))
+                    continue
+
+                if cfg.EVAL_BACKEND == "queue":
+                    batch_fits.append(self.record_job(x, args_key, jq.wait(job_ids[args_key])))
+                    continue
+
+                # Chromosomes are transcoded in batch order, wait for the transcode of x
+                item = transcoded.get()
+                if isinstance(item, BaseException): raise item
+                slot_root, slot_lock, comp_size, transcode_time, quality = item
+                try:
+                    batch_fits.append(self.evaluate_chromosome(x, args_key, comp_size, transcode_time,
+                                                               opool.get_eval_dir(slot_root), quality))
+                finally:
+                    opool.release_slot(slot_root, slot_lock)
+        finally:
+            # The transcodes of an aborted batch are stopped and their slots released
+            if cfg.EVAL_BACKEND != "queue": self.stop_transcode_pipeline(transcoded, stop)
+
+        return np.concatenate(batch_fits, axis=None)
+
+
+    def start_fitness_call(self, x):
+        '''
+        Counts and logs a fitness-call of chromosome x.
+        Chromosomes are identified by the ffmpeg arguments they result in,
+        distinct chromosomes often collapse to the same encoding. The
+        identifying key of x is returned.
+        '''
         self.calls += 1 # Keep track of amount of fitness-calls
         logger.info("------------- Fitness-call " + str(self.calls) + " ---------------")
-        x_id = str(np.round(x, 5))
-        logger.debug("Chromosome: " + x_id)
+        logger.debug("Chromosome: " + str(np.round(x, 5)))
+        return get_codec_args_key(x)
 
-        if x_id in self.fitness_dict:
-            logger.info("Using previous fitness of identical input vector")
-            self.store_results(x, self.fitness_dict[x_id], self.times[x_id], self.complete_results[x_id])
-            return self.fitness_dict[x_id]
 
-        # List all clips to degrade
-        clips = []
-        for clip in os.listdir(cfg.ML_DATA_INPUT):
-            if os.path.isdir(os.path.join(cfg.ML_DATA_INPUT, clip)):
-                clips.append(clip)
+    def lookup_fitness(self, x, args_key):
+        '''
+        Returns True if the fitness of args_key is known, either from earlier
+        fitness-calls or from the persistent cache.
+        Cached results are added to the results of this problem.
+        '''
+        if args_key in self.fitness_dict: return True
+
+        # Check for results of an identical encode in the persistent cache
+        cached = fcache.lookup(fcache.get_key(args_key, self.dataset_fingerprint, self.model_id))
+        if cached is None: return False
+        logger.info("Found cached fitness of identical encoding")
+        self.decision_vectors[args_key] = str(np.round(x, 5))
+        self.fitness_dict[args_key] = cached["fitness"]
+        self.times[args_key] = cached["time"]
+        self.complete_results[args_key] = cached["full_response"]
+        return True
+
 
-        # Remove any earlier degraded clips
-        for clip in clips:
+    def lookup_low_fidelity(self, x, args_key):
+        '''
+        Returns True if the low-fidelity fitness of args_key is known, either
+        from earlier fitness-calls or from the persistent cache
+        '''
+        if args_key in self.low_fidelity: return True
+        cached = fcache.lookup(fcache.get_key(args_key, self.subset_fingerprint, self.model_id, "low-fidelity"))
+        if cached is None: return False
+        logger.info("Found cached low-fidelity fitness of identical encoding")
+        self.low_fidelity[args_key] = (cached["fitness"], cached["time"], cached["full_response"])
+        return True
+
+
+    def screen_low_fidelity(self, pending):
+        '''
+        Scores the chromosomes of pending (args_key -> decision vector) on the
+        subset, like batch_fitness.
+        Returns the chromosomes of pending which are promoted to a full evaluation
+        '''
+        unscored = {key: x for key, x in pending.items() if not self.lookup_low_fidelity(x, key)}
+        logger.info("Low-fidelity evaluation of " + str(len(unscored)) + " chromosomes")
+        if cfg.EVAL_BACKEND == "queue":
+            job_ids = {args_key: jq.submit(x, "low") for args_key, x in unscored.items()}
+            for args_key, x in unscored.items():
+                self.record_job(x, args_key, jq.wait(job_ids[args_key]), low_fidelity=True)
+        else:
+            transcoded, stop = self.start_transcode_pipeline(list(unscored.values()), self.get_clips(cfg.MULTI_FIDELITY_INPUT),
+                                                             cfg.MULTI_FIDELITY_INPUT)
             try:
-                output_clip_dir = cfg.ML_DATA_OUTPUT + clip
-                shutil.rmtree(output_clip_dir, ignore_errors=False)
-            except:
-                logger.warning("Directory: " + str(cfg.ML_DATA_OUTPUT + clip) + " not found, moving on...")
+                for args_key, x in unscored.items():
+                    item = transcoded.get()
+                    if isinstance(item, BaseException): raise item
+                    slot_root, slot_lock, comp_size, transcode_time, quality = item
+                    try:
+                        self.evaluate_low_fidelity(x, args_key, comp_size, transcode_time, opool.get_eval_dir(slot_root), quality)
+                    finally:
+                        opool.release_slot(slot_root, slot_lock)
+            finally:
+                self.stop_transcode_pipeline(transcoded, stop)
+
+        promoted = {key: x for key, x in pending.items() if self.is_promoted(key)}
+        logger.info("Promoted " + str(len(promoted)) + " of " + str(len(pending)) + " chromosomes to full evaluation")
+        return promoted
+
+
+    def is_promoted(self, args_key):
+        '''
+        Returns False if the low-fidelity fitness of args_key is clearly
+        dominated, by a margin in both objectives, by a full evaluation
+        '''
+        score, comp_ratio = [-val for val in self.low_fidelity[args_key][0]]
+        for fitness in self.fitness_dict.values():
+            if(-fitness[0] >= score + cfg.MULTI_FIDELITY_MARGIN and
+               -fitness[1] >= comp_ratio * (1 + cfg.MULTI_FIDELITY_CR_MARGIN)):
+                return False
+        return True
+
+
+    def reject_chromosome(self, x, result):
+        '''
+        Records the fitness-call of a chromosome which is not evaluated in
+        full, either rejected at low fidelity or early rejected.
+        result is its (fitness, time, full_response), the fitness is returned
+        '''
+        fitness, transcode_time, full_response = result
+        logger.info("Chromosome rejected at " + full_response.get("fidelity", "low") + " fidelity, skipping full evaluation")
+        self.store_results(x, fitness, transcode_time, full_response)
+        return fitness
+
+
+    def get_score_ceiling(self, quality=None):
+        '''
+        Returns an upper bound of the ML-performance of an encode: no encode
+        beats the ML-performance on the original dataset by more than
+        EARLY_REJECTION_MARGIN.
+        With EARLY_REJECTION_QUALITY_BOUND set the bound is tightened by the
+        quality metrics of the encode, heuristically: no encode is expected
+        to beat a full evaluation which is at least as good in both PSNR and
+        SSIM by more than EARLY_REJECTION_MARGIN. ML-performance is not
+        monotonic in PSNR and SSIM, so this bound can reject encodes which
+        would have been non-dominated
+        '''
+        ceiling = cfg.ML_PERFORMANCE_BASELINE + cfg.EARLY_REJECTION_MARGIN
+        if not quality or not cfg.EARLY_REJECTION_QUALITY_BOUND: return ceiling
+        for args_key, fitness in self.fitness_dict.items():
+            evaluated = self.complete_results[args_key].get("quality")
+            if evaluated and evaluated["psnr"] >= quality["psnr"] and evaluated["ssim"] >= quality["ssim"]:
+                ceiling = min(ceiling, -fitness[0] + cfg.EARLY_REJECTION_MARGIN)
+        return ceiling
+
+
+    def is_dominated(self, comp_ratio, score_ceiling):
+        '''
+        Returns True if a full evaluation has at least the compression ratio
+        comp_ratio and a higher ML-performance than score_ceiling
+        '''
+        for fitness in self.fitness_dict.values():
+            if -fitness[0] > score_ceiling and -fitness[1] >= comp_ratio: return True
+        return False
+
+
+    def reject_early(self, x, args_key, comp_ratio, score_ceiling, transcode_time, quality=None):
+        '''
+        Records chromosome x, whose encode is dominated given its score ceiling,
+        without an ML-evaluation. Its score is pessimistic but bounded by the
+        lowest ML-performance of the full evaluations.
+        Returns the fitness of x
+        '''
+        score = min([score_ceiling] + [-fitness[0] for fitness in self.fitness_dict.values()])
+        full_response = {"fidelity": "rejected", "score_ceiling": score_ceiling}
+        if quality: full_response["quality"] = quality
+        logger.info("Encode dominated at comp-ratio: " + str(comp_ratio) + " and ML-performance ceiling: " +
+                    str(score_ceiling) + ", skipping ML-evaluation")
+        self.decision_vectors[args_key] = str(np.round(x, 5))
+        self.rejected[args_key] = ([-score, -comp_ratio], transcode_time, full_response)
+        self.store_results(x, [-score, -comp_ratio], transcode_time, full_response)
+        return [-score, -comp_ratio]
 
-        # Parse x into a dict of encoding arguments
-        comp_size = 0
 
-        # Apply degredation to every clip
+    def get_clips(self, input_dir=None):
+        '''Lists all clips to degrade, of ML_DATA_INPUT if input_dir is not given'''
+        if input_dir is None: input_dir = cfg.ML_DATA_INPUT
+        clips = []
+        for clip in os.listdir(input_dir):
+            if os.path.isdir(os.path.join(input_dir, clip)):
+                clips.append(clip)
+        return clips
+
+
+    def transcode_chromosome(self, x, output_dir, clips, input_dir=None):
+        '''
+        Applies the degredation of chromosome x to every clip of input_dir,
+        ML_DATA_INPUT if not given, writing the degraded clips to output_dir.
+        Returns the compressed size, the time of the transcode and the
+        quality metrics of the encodes (empty unless QUALITY_METRICS is set)
+        '''
+        if input_dir is None: input_dir = cfg.ML_DATA_INPUT
         start_time = time.time()
         logger.info("Starting trancode process")
-        for clip in clips:
-            input_clip_dir = cfg.ML_DATA_INPUT + clip
-            output_clip_dir = cfg.ML_DATA_OUTPUT + clip
-            logger.debug("Applying degredation to clip: " + input_clip_dir)
-            comp_size += ffu.transcode(input_clip_dir, output_clip_dir, x)
+        comp_size, quality = ffu.transcode_clips(input_dir, output_dir, clips, x)
         transcode_time = time.time() - start_time
         logger.info("Time for transcode: " + str(int(round(transcode_time)))+" seconds")
+        if quality: logger.info("PSNR: " + str(quality["psnr"]) + " SSIM: " + str(quality["ssim"]))
+        return comp_size, transcode_time, quality
+
+
+    def start_transcode_pipeline(self, chromosomes, clips, input_dir=None):
+        '''
+        Transcodes the clips of input_dir for chromosomes in a background
+        thread, each into a slot of the output pool.
+        Returns a queue which receives (slot root, slot lock, compressed size, transcode time,
+        quality metrics) of every chromosome in order, or the exception which stopped the transcoding,
+        followed by None, and the event which stops the transcoding (stop_transcode_pipeline).
+        The receiver releases the slots. At most PIPELINE_DEPTH transcoded chromosomes
+        wait in the queue and the pool size bounds the disk usage.
+        '''
+        transcoded = queue.Queue(maxsize=cfg.PIPELINE_DEPTH)
+        stop = threading.Event()
+
+        def transcode_all():
+            try:
+                for x in chromosomes:
+                    if stop.is_set(): break
+                    slot_root, slot_lock = opool.acquire_slot()
+                    if stop.is_set():
+                        opool.release_slot(slot_root, slot_lock)
+                        break
+                    try:
+                        comp_size, transcode_time, quality = self.transcode_chromosome(x, opool.get_output_dir(slot_root), clips, input_dir)
+                    except BaseException:
+                        opool.release_slot(slot_root, slot_lock)
+                        raise
+                    transcoded.put((slot_root, slot_lock, comp_size, transcode_time, quality))
+            except BaseException as ex:
+                transcoded.put(ex)
+            transcoded.put(None)
+
+        threading.Thread(target=transcode_all, daemon=True).start()
+        return transcoded, stop
+
+
+    def stop_transcode_pipeline(self, transcoded, stop):
+        '''
+        Stops the transcoding of start_transcode_pipeline once the receiver
+        is done, also if it stopped early, and releases the slots of the
+        chromosomes which were transcoded but never received
+        '''
+        stop.set()
+        while(True):
+            item = transcoded.get()
+            if item is None: return
+            if not isinstance(item, BaseException): opool.release_slot(item[0], item[1])
+
+
+    def evaluate_chromosome(self, x, args_key, comp_size, transcode_time, eval_dir=None, quality=None):
+        '''
+        Evaluates the degraded clips of the dataset root eval_dir, ML_DATA_OUTPUT
+        if not given, records the results of chromosome x and returns its fitness.
+        Quality metrics of the encode are recorded along with the ML-measures.
+        With EARLY_REJECTION set, encodes which are dominated given the bound
+        of get_score_ceiling are rejected without an ML-evaluation
+        '''
+        comp_ratio = self.original_img_size/comp_size               # Calc compression-ratio
+        if cfg.EARLY_REJECTION:
+            score_ceiling = self.get_score_ceiling(quality)
+            if self.is_dominated(comp_ratio, score_ceiling):
+                return self.reject_early(x, args_key, comp_ratio, score_ceiling, transcode_time, quality)
 
         # Retrieve fitness results
         logger.info("Requesting evaluation from ML-algorithm...")
-        score, full_response = rest_com.get_eval_from_ml_alg()    # Get ML-algorithm results 
-        comp_ratio = self.original_img_size/comp_size               # Calc compression-ratio
+        score, full_response = rest_com.get_eval_from_ml_alg(eval_dir=eval_dir)    # Get ML-algorithm results 
+        if quality: full_response["quality"] = quality
+        return self.record_fitness(x, args_key, score, comp_ratio, transcode_time, full_response)
+
+
+    def record_fitness(self, x, args_key, score, comp_ratio, transcode_time, full_response):
+        '''
+        Records the results of a full evaluation of chromosome x and returns its fitness
+        '''
         logger.info("ML-performance: " + str(score) + "\nComp-ratio: " + str(comp_ratio))
         logger.debug("All measures: " + str(full_response))
 
-        self.fitness_dict[x_id] = [-score, -comp_ratio]
-        self.times[x_id] = transcode_time
-        self.complete_results[x_id] = full_response
+        self.decision_vectors[args_key] = str(np.round(x, 5))
+        self.fitness_dict[args_key] = [-score, -comp_ratio]
+        self.times[args_key] = transcode_time
+        self.complete_results[args_key] = full_response
+        fcache.store(fcache.get_key(args_key, self.dataset_fingerprint, self.model_id),
+                     {"fitness": [-score, -comp_ratio], "time": transcode_time, "full_response": full_response},
+                     args_key, self.dataset_fingerprint)
         self.store_results(x, [-score, -comp_ratio], transcode_time, full_response)
 
         # Minimize bitrate, maximize ML-performance
         return [-score, -comp_ratio]  # maximize obj-func -> put a minus sign in front of obj.
 
 
+    def evaluate_low_fidelity(self, x, args_key, comp_size, transcode_time, eval_dir=None, quality=None):
+        '''
+        Evaluates the degraded clips of the subset in the dataset root
+        eval_dir and records the low-fidelity fitness of chromosome x,
+        apart from the full evaluations
+        '''
+        logger.info("Requesting low-fidelity evaluation from ML-algorithm...")
+        eval_list = cfg.MULTI_FIDELITY_LIST if cfg.ML_DATA_LIST is not None else None
+        score, full_response = rest_com.get_eval_from_ml_alg(eval_list=eval_list, eval_dir=eval_dir)
+        if quality: full_response["quality"] = quality
+        full_response["fidelity"] = "low"
+        return self.record_low_fidelity(x, args_key, score, self.subset_img_size/comp_size, transcode_time, full_response)
+
+
+    def record_low_fidelity(self, x, args_key, score, comp_ratio, transcode_time, full_response):
+        '''
+        Records the results of a low-fidelity evaluation of chromosome x and
+        returns its low-fidelity fitness
+        '''
+        logger.info("Low-fidelity ML-performance: " + str(score) + "\nComp-ratio: " + str(comp_ratio))
+
+        self.low_fidelity[args_key] = ([-score, -comp_ratio], transcode_time, full_response)
+        fcache.store(fcache.get_key(args_key, self.subset_fingerprint, self.model_id, "low-fidelity"),
+                     {"fitness": [-score, -comp_ratio], "time": transcode_time, "full_response": full_response},
+                     args_key, self.subset_fingerprint)
+        return [-score, -comp_ratio]
+
+
+    def record_job(self, x, args_key, result, low_fidelity=False):
+        '''
+        Records the result of an evaluation job of chromosome x, as posted
+        by a worker of the job queue, and returns its fitness
+        '''
+        if low_fidelity:
+            return self.record_low_fidelity(x, args_key, result["score"], result["comp_ratio"],
+                                            result["time"], result["full_response"])
+        return self.record_fitness(x, args_key, result["score"], result["comp_ratio"],
+                                   result["time"], result["full_response"])
+
+
     def store_results(self, x, fitness, time, full_response):
         '''
         Stores decision vectors and their fitness.
@@ -137,6 +524,7 @@ class sweetspot_problem:
             # Name used to identify plots and files
             name = (cfg.video_encoder + ":" + cfg.rate_control + " at epoch:" +
                     str(cfg.epoch) + " of MOGA: " + cfg.MOG_ALG)
+            if self.island is not None: name += " island:" + str(self.island)
 
             # If this is the last generation, plot and print extended epoch information
             if(self.gen == cfg.NO_GENERATIONS):
@@ -157,6 +545,8 @@ class sweetspot_problem:
             data = [str(self.calls), str(cfg.epoch), cfg.video_encoder, cfg.MOG_ALG, np.array2string(x, precision = 6, separator=','), str(time)]
             data = np.concatenate((data, fitness), axis=None)
             data = np.concatenate((data, str(full_response)), axis=None)
+            # Rate control, ML-model and fidelity identify the history the surrogate mode is trained on
+            data = np.concatenate((data, [cfg.rate_control, cfg.ML_MODEL, full_response.get("fidelity", "full")]), axis=None)
             data_writer.writerow(data)
 
     def write_ndf_csv(self, name):
@@ -173,6 +563,6 @@ class sweetspot_problem:
         with open(cfg.RESULTS_PATH + cfg.timestamp + '/NDF-' + name + '.csv', mode='w') as data_file:
             data_writer = csv.writer(data_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
             for i in ndf:
-                data = np.concatenate((fitness_keys[i], fitness_values[i]), axis=None)
+                data = np.concatenate((self.decision_vectors[fitness_keys[i]], fitness_values[i]), axis=None)
                 data = np.concatenate((data, self.complete_results[fitness_keys[i]]), axis=None)
                 data_writer.writerow(data)
\ No newline at end of file
@@ -0,0 +1,87 @@
+# By: Oscar Andersson 2019
+
+import os, sys, logging
+import numpy as np
+import pytest
+
+pyg = pytest.importorskip("pygmo")
+pytest.importorskip("matplotlib")
+pytest.importorskip("ffmpeg")
+pytest.importorskip("requests")
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_ROOT)
+import config.config as cfg
+from utils.enc_arg_parser import get_codec_args_key
+
+
+class synthetic_problem:
+    '''
+    Stands in for sweetspot_problem with a cheap fitness over the real
+    bounds of the encoder, records every evaluation like data.csv does
+    '''
+
+    def __init__(self):
+        self.fitness_dict = {}
+        self.X = []
+        self.F = []
+
+    def get_bounds(self):
+        return (cfg.opt_low_bounds, cfg.opt_high_bounds)
+
+    def get_nobj(self):
+        return 2
+
+    def get_nix(self):
+        return len(cfg.opt_params)-cfg.no_continous
+
+    def fitness(self, x):
+        low, high = np.array(cfg.opt_low_bounds, dtype=float), np.array(cfg.opt_high_bounds, dtype=float)
+        u = (np.array(x) - low) / np.where(high > low, high - low, 1.0)
+        score = 0.8 - 0.3*u[0]**2 - 0.05*u[1] + 0.02*np.mean(np.sin(3*u[2:]))
+        comp_ratio = np.exp(4*u[0] + 0.5*u[1] + 0.2*np.sum(u[3:6]))
+        fitness = [-score, -comp_ratio]
+        self.fitness_dict[get_codec_args_key(x)] = fitness
+        self.X.append(list(x))
+        self.F.append(fitness)
+        return fitness
+
+    def batch_fitness(self, dvs):
+        return np.concatenate([self.fitness(x) for x in np.reshape(dvs, (-1, len(cfg.opt_params)))])
+
+
+@pytest.fixture
+def moga(monkeypatch):
+    monkeypatch.chdir(REPO_ROOT)
+    import moga
+    monkeypatch.setattr(cfg, "logger", logging.getLogger('gen-alg'), raising=False)
+    monkeypatch.setattr(moga, "logger", logging.getLogger('gen-alg'), raising=False)
+    monkeypatch.setattr(moga, "sweetspot_problem", synthetic_problem)
+    cfg.load_params_from_json("libx264", "CRF")
+    return moga
+
+
+def test_surrogate_is_used_on_libx264_bounds(moga, monkeypatch, caplog):
+    import utils.surrogate as surrogate
+    caplog.set_level(logging.INFO, logger='gen-alg')
+
+    # A history of 13 generations, as earlier runs leave in their data.csv files
+    prob = pyg.problem(synthetic_problem())
+    pop = pyg.population(prob, cfg.POP_SIZE, seed=3)
+    opt_alg = moga.get_optimization_algorithm(3)
+    opt_alg.set_verbosity(0)
+    for _ in range(12):
+        pop = opt_alg.evolve(pop)
+    udp = pop.problem.extract(synthetic_problem)
+    assert len(cfg.opt_params) > 20 and len(udp.X) >= cfg.SURROGATE_MIN_HISTORY
+    history = (np.array(udp.X), np.array(udp.F))
+    monkeypatch.setattr(surrogate, "load_history", lambda results_path: history)
+
+    evaluations = len(udp.X)
+    pop = moga.surrogate_evolve(opt_alg, pop)
+
+    messages = [record.getMessage() for record in caplog.records]
+    assert any(message.startswith("Surrogate selected") for message in messages)
+    assert not any("without surrogate" in message for message in messages)
+    # Exactly the selected offspring were evaluated for real
+    assert len(pop.problem.extract(synthetic_problem).X) == evaluations + cfg.POP_SIZE
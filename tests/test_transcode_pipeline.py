@@ -0,0 +1,70 @@
+# By: Oscar Andersson 2019
+
+import os, sys, logging, threading
+import numpy as np
+import pytest
+
+pytest.importorskip("pygmo")
+pytest.importorskip("matplotlib")
+pytest.importorskip("ffmpeg")
+pytest.importorskip("requests")
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO_ROOT)
+import config.config as cfg
+import utils.output_pool as opool
+import optimization_problem as op
+
+NO_CHROMOSOMES = 6
+
+
+@pytest.fixture
+def problem(monkeypatch):
+    '''
+    A sweetspot_problem whose transcodes and output slots are stubbed,
+    the slots acquired and released are counted
+    '''
+    monkeypatch.chdir(REPO_ROOT)
+    monkeypatch.setattr(cfg, "logger", logging.getLogger('gen-alg'), raising=False)
+    cfg.load_params_from_json("libx264", "CRF")
+    monkeypatch.setattr(cfg, "PIPELINE_DEPTH", 1)
+    monkeypatch.setattr(cfg, "MULTI_FIDELITY", False)
+    monkeypatch.setattr(cfg, "EVAL_BACKEND", "local")
+
+    slots = {"acquired": 0, "released": 0}
+    lock = threading.Lock()
+    def acquire_slot():
+        with lock: slots["acquired"] += 1
+        return "slot", None
+    def release_slot(slot_root, slot_lock):
+        with lock: slots["released"] += 1
+    monkeypatch.setattr(opool, "acquire_slot", acquire_slot)
+    monkeypatch.setattr(opool, "release_slot", release_slot)
+
+    prob = op.sweetspot_problem.__new__(op.sweetspot_problem)
+    prob.fitness_dict, prob.rejected = {}, {}
+    prob.slots = slots
+    monkeypatch.setattr(prob, "lookup_fitness", lambda x, args_key: False, raising=False)
+    monkeypatch.setattr(prob, "get_clips", lambda input_dir=None: [], raising=False)
+    monkeypatch.setattr(prob, "start_fitness_call", lambda x: None, raising=False)
+    monkeypatch.setattr(prob, "transcode_chromosome", lambda x, output_dir, clips, input_dir: (1, 0., None), raising=False)
+    return prob
+
+
+def test_aborted_batch_releases_every_slot(problem, monkeypatch):
+    evaluations = []
+    def evaluate_chromosome(x, args_key, comp_size, transcode_time, eval_dir=None, quality=None):
+        evaluations.append(args_key)
+        if len(evaluations) == 2: raise RuntimeError("ML-algorithm unavailable")
+        return [-0.5, -10.]
+    monkeypatch.setattr(problem, "evaluate_chromosome", evaluate_chromosome, raising=False)
+
+    chromosomes = np.array([cfg.opt_low_bounds] * NO_CHROMOSOMES, dtype=float)
+    chromosomes[:, 0] = np.arange(NO_CHROMOSOMES)
+    with pytest.raises(RuntimeError):
+        problem.batch_fitness(chromosomes.flatten())
+
+    # The remaining transcodes are stopped and every acquired slot is released
+    assert len(evaluations) == 2
+    assert problem.slots["acquired"] < NO_CHROMOSOMES
+    assert problem.slots["acquired"] == problem.slots["released"]
@@ -8,16 +8,23 @@ from multiprocessing import Pool
 import config.config as cfg
 import utils.plotting as pl
 from tqdm import trange
-import random, logging, os, argparse, csv, re, json, shutil, time
+import random, logging, os, argparse, csv, re, json, shutil, time, tempfile, atexit
 from datetime import datetime
 
 import utils.ffmpeg_utils as ffu    # import functions from ffmpeg_utils.py
 import utils.rest_communication as restcom # import functions from rest_communication.py
+import utils.fitness_cache as fcache
+import utils.frame_store as fstore
+from utils.enc_arg_parser import get_codec_args_key
 
 # Global logger object
 logger = None
 ORIG_TEST = False
 
+# Worker pool of the structural comparisons, shared by the whole run
+COMPARISON_WORKERS = 16
+comparison_pool = None
+
 
 def degrade_eval(codec_arg, rate_control_arg, csvpath, degradation):
 
@@ -41,6 +48,9 @@ def degrade_eval(codec_arg, rate_control_arg, csvpath, degradation):
         # Loading coding parameters from CSV
         param_sets = load_param_set(csvpath)
 
+    # Results of other checkpoints of the ML-model are never reused
+    model_id = restcom.get_model_id()
+
     # Iterate through each scenario and evaluate each set of coding parameters
     logger.info("Scenarios: " + str(scenarios))
     for i in trange(len(scenarios)):
@@ -49,10 +59,24 @@ def degrade_eval(codec_arg, rate_control_arg, csvpath, degradation):
         input_scenario_dir = ML_DATA_INPUT +"/"+ scenario
         output_scenario_dir = cfg.ML_DATA_OUTPUT +"/scenario"
         original_scenario_size = ffu.get_directory_size(input_scenario_dir)
+        scenario_fingerprint = fcache.get_dataset_fingerprint(input_scenario_dir)
+        if cfg.SOURCE_FRAME_CACHE and not ORIG_TEST: ffu.cache_source(input_scenario_dir)
+        originals_dir = None
         results = {}
 
         # Iterate through each set of coding parameters
         for param_set in param_sets:
+            # Reuse the results of an identical encode of the scenario
+            cache_key = None
+            if not ORIG_TEST:
+                args_key = get_codec_args_key(param_set)
+                cache_key = fcache.get_key(args_key, scenario_fingerprint, model_id, "degrade-eval:" + scenario)
+                cached = fcache.lookup(cache_key)
+                if cached is not None:
+                    logger.info("Using cached results of identical encoding")
+                    results[decision_vector_to_string(param_set)] = cached["results"]
+                    continue
+
             # Remove any earlier degraded scenarios
             shutil.rmtree(output_scenario_dir, ignore_errors=True)
 
@@ -66,14 +90,25 @@ def degrade_eval(codec_arg, rate_control_arg, csvpath, degradation):
                     logger.error(e)
                     exit(1)
             else:
-                comp_size = ffu.transcode(input_scenario_dir, output_scenario_dir, param_set)
+                frame_indices = None
+                if cfg.EVAL_FRAMES_ONLY:
+                    frame_indices = ffu.get_eval_frame_indices(len(ffu.get_frame_names(input_scenario_dir)))
+                comp_size = ffu.transcode(input_scenario_dir, output_scenario_dir, param_set, frame_indices)
                 # Comparison between original and compressed frames using mean SSMI, PSNR and other metrics
-                mean_comparison_results = get_structural_comparison(input_scenario_dir, output_scenario_dir)
+                if originals_dir is None:
+                    originals_dir = tempfile.mkdtemp(prefix="moga-orig-", dir=cfg.TEMP_STORAGE_DIR)
+                    decode_originals(input_scenario_dir, originals_dir)
+                mean_comparison_results = get_structural_comparison(originals_dir, output_scenario_dir).tolist()
 
             # Retrieve fitness results
             _, full_response = restcom.get_eval_from_ml_alg(eval_list=scenario)    # Get ML-algorithm results 
             comp_ratio = original_scenario_size/comp_size               # Calc compression-ratio
             results[decision_vector_to_string(param_set)] = [*full_response.values(), comp_ratio, *mean_comparison_results]
+            if cache_key is not None:
+                fcache.store(cache_key, {"results": results[decision_vector_to_string(param_set)]},
+                             args_key, scenario_fingerprint)
+
+        if originals_dir is not None: shutil.rmtree(originals_dir, ignore_errors=True)
 
         # Save scenario results to CSV-file
         with open(cfg.RESULTS_PATH+cfg.timestamp+'/'+codec_arg+'_'+rate_control_arg+'_results.csv', mode='a') as data_file:
@@ -100,24 +135,51 @@ def degrade_eval_dirs(path, degradation):
         degrade_eval(codec_arg, rate_control_arg, file_path, degradation)
 
 
-def get_structural_comparison(orig_path, comp_path):
+def get_comparison_pool():
+    '''Returns the worker pool of the structural comparisons, created on first use'''
+    global comparison_pool
+    if comparison_pool is None:
+        comparison_pool = Pool(processes=COMPARISON_WORKERS)
+        atexit.register(comparison_pool.terminate)
+    return comparison_pool
+
 
+def decode_originals(orig_path, store_dir):
+    '''
+    Decodes the original frames which are compared to the degraded ones
+    into a frame store in store_dir. The store is kept in tmpfs and
+    memory-mapped by the workers, the originals are decoded once per scenario
+    '''
     # Get the filenames of all images in the original dataset
     filenames = ffu.get_names(orig_path)
-    
+
     # Cityscapes: Only evaluate the frames which are evaluated by the ML-algorithms
-    reduced_set = []
-    for i in range(0, len(filenames)//30):
-        reduced_set.append(filenames[i*30 + 19])
-    filenames = reduced_set
-    
+    filenames = [filenames[i] for i in ffu.get_eval_frame_indices(len(filenames))]
+
+    height, width = read_image(os.path.join(orig_path, filenames[0])).shape[:2]
+    # Workers fill the store, only its header is written here
+    frames = fstore.create_store(store_dir, filenames, height, width)
+    del frames
+    get_comparison_pool().map(decode_original, [ (os.path.join(orig_path, filenames[i]), store_dir, i)
+                                                  for i in range(len(filenames)) ])
+
+
+def decode_original(args):
+    img_path, store_dir, index = args
+    _, frames = fstore.open_store(store_dir, mode='r+')
+    frames[index] = read_image(img_path)
+    frames.flush()
+
+
+def get_structural_comparison(originals_dir, comp_path):
+
+    # The originals are compared with the degraded frames of the same name
+    filenames, _ = fstore.open_store(originals_dir)
+
     # Use pool of workers to evaluate images in parallel
-    pool = Pool(processes=16)
-    calc_map = [ (os.path.join(orig_path, filename),
-                  os.path.join(comp_path, filename))
-                  for filename in filenames ]
-    res_arr = pool.map(parallel_comparison, calc_map)
-    pool.terminate()
+    calc_map = [ (originals_dir, i, os.path.join(comp_path, filenames[i]))
+                  for i in range(len(filenames)) ]
+    res_arr = get_comparison_pool().map(parallel_comparison, calc_map)
 
     # Calculate the mean values from evals
     mean_results = np.mean(res_arr, axis=0)
@@ -125,17 +187,40 @@ def get_structural_comparison(orig_path, comp_path):
 
 
 def parallel_comparison(args):
-    orig_path, comp_path = args
-    orig_img = io.imread(orig_path)
-    comp_img = io.imread(comp_path)
+    originals_dir, index, comp_path = args
+    _, originals = fstore.open_store(originals_dir)
+    orig_img = np.asarray(originals[index])
+    comp_img = read_image(comp_path)
+    return compare_images(orig_img, comp_img)
+
+
+def compare_images(orig_img, comp_img):
+    '''
+    Returns the SSIM, PSNR, MSE and NRMSE of a degraded image, the last
+    three are computed from one difference image
+    '''
+    orig = orig_img.astype(np.float64)
+    diff = orig - comp_img
+    mse = np.mean(np.square(diff))
+    psnr = 10 * np.log10(np.iinfo(orig_img.dtype).max ** 2 / mse) if mse > 0 else np.inf
+    nrmse = np.sqrt(mse) / np.sqrt(np.mean(np.square(orig)))
+
     comparisons = []
     comparisons.append(metrics.structural_similarity(orig_img, comp_img, multichannel=True))
-    comparisons.append(metrics.peak_signal_noise_ratio(orig_img, comp_img))
-    comparisons.append(metrics.mean_squared_error(orig_img, comp_img))
-    comparisons.append(metrics.normalized_root_mse(orig_img, comp_img))
+    comparisons.append(psnr)
+    comparisons.append(mse)
+    comparisons.append(nrmse)
     return comparisons
 
 
+def read_image(img_path):
+    '''Reads an image file, or the frame of the same name if its directory is a frame store'''
+    img_dir, img_name = os.path.split(img_path)
+    if fstore.has_store(img_dir):
+        return fstore.read_frame(img_dir, img_name)
+    return io.imread(img_path)
+
+
 def decision_vector_to_string(d_vector):
     string = ""
     for vector in d_vector:
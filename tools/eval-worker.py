@@ -0,0 +1,120 @@
+# By: Oscar Andersson 2019
+
+# Imports
+import numpy as np
+import logging, os, argparse, socket, threading, time
+
+import config.config as cfg
+import utils.ffmpeg_utils as ffu    # import functions from ffmpeg_utils.py
+import utils.rest_communication as restcom # import functions from rest_communication.py
+import utils.output_pool as opool
+import utils.multi_fidelity as mfid
+import utils.job_queue as jq
+
+# Global logger object
+logger = None
+
+# Sizes of the original datasets, by input directory
+original_sizes = {}
+
+
+def get_original_size(input_dir):
+    '''
+    Returns the size of the original dataset of input_dir
+    '''
+    if input_dir not in original_sizes:
+        original_sizes[input_dir] = ffu.get_directory_size(input_dir)
+    return original_sizes[input_dir]
+
+
+def get_input_dir(fidelity):
+    '''
+    Returns the input dataset of a fidelity, the low-fidelity subset is
+    created on first use
+    '''
+    if fidelity != "low": return cfg.ML_DATA_INPUT
+    if cfg.MULTI_FIDELITY_INPUT not in original_sizes:
+        mfid.write_eval_list(mfid.create_subset(cfg.ML_DATA_INPUT, cfg.MULTI_FIDELITY_INPUT))
+    return cfg.MULTI_FIDELITY_INPUT
+
+
+def evaluate_job(job):
+    '''
+    Transcodes the clips of a job and evaluates them with the ML-algorithm of this worker.
+    Returns the result which is posted to the job queue
+    '''
+    cfg.restore_run_state(job["run_state"])
+    x = np.array(job["x"])
+    input_dir = get_input_dir(job["fidelity"])
+    clips = [clip for clip in os.listdir(input_dir) if os.path.isdir(os.path.join(input_dir, clip))]
+    eval_list = None
+    if job["fidelity"] == "low" and cfg.ML_DATA_LIST is not None: eval_list = cfg.MULTI_FIDELITY_LIST
+
+    slot_root, slot_lock = opool.acquire_slot()
+    try:
+        start_time = time.time()
+        comp_size, quality = ffu.transcode_clips(input_dir, opool.get_output_dir(slot_root), clips, x)
+        transcode_time = time.time() - start_time
+        score, full_response = restcom.get_eval_from_ml_alg(eval_list=eval_list, eval_dir=opool.get_eval_dir(slot_root))
+    finally:
+        opool.release_slot(slot_root, slot_lock)
+
+    if quality: full_response["quality"] = quality
+    if job["fidelity"] == "low": full_response["fidelity"] = "low"
+    return {"score": score, "comp_ratio": get_original_size(input_dir)/comp_size,
+            "time": transcode_time, "full_response": full_response}
+
+
+def run_worker(worker):
+    '''
+    Leases jobs from the job queue and evaluates them until interrupted.
+    The lease of a job is renewed while it is evaluated, failed jobs are
+    returned to the queue
+    '''
+    logger.info("Worker " + worker + " polling " + cfg.JOB_QUEUE_PATH)
+    while(True):
+        job = jq.lease(worker)
+        if job is None:
+            time.sleep(cfg.JOB_POLL_INTERVAL)
+            continue
+        logger.info("Evaluating job " + str(job["id"]) + " at " + job["fidelity"] + " fidelity")
+
+        evaluated = threading.Event()
+        def renew_lease():
+            while not evaluated.wait(cfg.JOB_LEASE_TIME / 3):
+                if not jq.renew(job["id"], worker): logger.warning("Lost lease of job " + str(job["id"]))
+        threading.Thread(target=renew_lease, daemon=True).start()
+
+        try:
+            result = evaluate_job(job)
+        except Exception as ex:
+            logger.exception("Job " + str(job["id"]) + " failed")
+            jq.fail(job["id"], worker, str(ex))
+            continue
+        finally:
+            evaluated.set()
+        jq.complete(job["id"], worker, result)
+        logger.info("Job " + str(job["id"]) + " done, ML-performance: " + str(result["score"]) +
+                    " Comp-ratio: " + str(result["comp_ratio"]))
+
+
+if(__name__ == "__main__"):
+    '''
+    Starts an evaluation worker which serves the job queue
+    '''
+    logger = logging.getLogger('gen-alg')
+    cfg.configure_logging()
+
+    parser = argparse.ArgumentParser(description='Evaluation worker of the job queue')
+    parser.add_argument('-q', '--queue', default=None, help="Job queue database, JOB_QUEUE_PATH if not given")
+    parser.add_argument('-a', '--address', default=None, help="Address of the ML-algorithm of this worker, ML_ADDRESS if not given")
+    parser.add_argument('-n', '--name', default=None, help="Name of the worker, hostname:pid if not given")
+
+    args = parser.parse_args()
+
+    if args.queue is not None: cfg.JOB_QUEUE_PATH = args.queue
+    if args.address is not None:
+        cfg.REQUEST_ADDRESS = args.address + "/eval"
+        cfg.MODEL_ADDRESS = args.address + "/model"
+    worker = args.name or socket.gethostname() + ":" + str(os.getpid())
+    run_worker(worker)
@@ -1,5 +1,5 @@
 # By: Oscar Andersson 2019
-import logging
+import logging, json
 logger = logging.getLogger('gen-alg')
 import config.config as cfg
 
@@ -21,6 +21,8 @@ def get_codec_args(decision_vector):
 
     for key in cfg.opt_constants.keys():
         output_args[key] = cfg.opt_constants[key]
+    # Frame threading changes the bitstream, so the thread count is part of the arguments and their key
+    if cfg.TRANSCODE_THREADS > 0: output_args["threads"] = cfg.TRANSCODE_THREADS
 
     # Add each coding parameter to the output arguments that FFMPEG will use
     for i in range(0, len(cfg.opt_params)):
@@ -58,6 +60,24 @@ def get_codec_args(decision_vector):
 
 
 
+def get_codec_args_key(decision_vector):
+    '''
+    Returns a canonical string of the ffmpeg arguments which decision_vector
+    results in. Decision vectors resulting in identical ffmpeg commands
+    have identical keys.
+    '''
+    input_args, output_args, is_two_pass = get_codec_args(decision_vector)
+
+    # ffmpeg receives every argument as a string
+    args = {
+        "input": {key: str(val) for key, val in input_args.items()},
+        "output": {key: str(val) for key, val in output_args.items()},
+        "two_pass": is_two_pass
+    }
+    return json.dumps(args, sort_keys=True)
+
+
+
 def get_libx264_args(input_args, output_args, x):
     '''Gets the input and output arguments for the libx264 FFMPEG-encoder'''
 
@@ -84,8 +104,10 @@ def get_libx264_args(input_args, output_args, x):
     if cfg.rate_control != "Near-LL":
         # Adjust parameters according to compatability
         if(output_args["coder"] == "vlc"): output_args["trellis"] = 0
-        if(output_args["subq"] == 10 and (output_args["aq-mode"]==0 or output_args["trellis"]!= 2)): output_args["subq"] = 9
-        if(output_args["psy"] == 1 and not (output_args["subq"] >= 6 and output_args["trellis"] >= 1)): output_args["psy"] == 0
+        # x264 lowers subme 10 to 9 itself without trellis 2 and aq, applying it here gives equal encodes equal arguments
+        if(output_args["subq"] == 10 and (output_args["aq-mode"]=="none" or output_args["trellis"]!= 2)): output_args["subq"] = 9
+        # psy-rd needs subme >= 6 and psy-trellis needs trellis, psy only has no effect without both
+        if(output_args["psy"] == 1 and output_args["subq"] < 6 and output_args["trellis"] == 0): output_args["psy"] = 0
 
 
     # Remove tune flag if no tuning parameter is passed
@@ -1,35 +1,32 @@
 # By: Oscar Andersson 2019
 
-import os, logging, ffmpeg, time
+import os, logging, ffmpeg, time, tempfile, shutil, threading, fcntl
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from utils.enc_arg_parser import get_codec_args
+import utils.frame_store as fstore
 import config.config as cfg
 logger = logging.getLogger('gen-alg')
 
 
-def img_to_vid(images_dir, decision_vector):
+def img_to_vid(images_dir, decision_vector, out_path, passlog_prefix):
     '''
-    Converts images of a directory to a video-file
+    Converts images of a directory, or the frames of a frame store, to a video-file
     '''
 
     input_args, output_args, is_two_pass = get_codec_args(decision_vector)
 
     logger.debug("Img -> Vid")
     logger.debug(str(input_args)+ " " +str(output_args))
-    filenaming = str(images_dir+'/'+'*.'+ cfg.IMAGE_TYPE)
-    out_path = cfg.TEMP_STORAGE_PATH
+    video_input, frames = get_video_input(images_dir, input_args)
 
     if(is_two_pass):
         try:
             logger.debug("Applying two passes!")
+            output_args["passlogfile"] = passlog_prefix
             output_args["pass"] = "1"
-            (
-                ffmpeg
-                .input(filenaming, **input_args)
-                .output("/dev/null", **output_args)
-                .global_args('-loglevel', 'error', "-stats", "-hide_banner", "-y")
-                .run(capture_stderr=True)
-            )
+            run_ffmpeg(video_input.output("/dev/null", **output_args), frames)
             output_args["pass"] = "2"
         except ffmpeg.Error as ex:
             logger.critical("FFMPEG: error converting images to video")
@@ -38,13 +35,7 @@ def img_to_vid(images_dir, decision_vector):
             raise Exception("Failed transcode")
 
     try:
-        (
-            ffmpeg
-            .input(filenaming, **input_args)
-            .output(out_path, **output_args)
-            .global_args('-loglevel', 'error', "-stats", "-hide_banner", "-y")
-            .run(capture_stderr=True)
-        )
+        run_ffmpeg(video_input.output(out_path, **output_args), frames)
     except ffmpeg.Error as ex:
         logger.critical("FFMPEG: error converting images to video")
         logger.critical(ex.stderr.decode('utf8'))
@@ -52,81 +43,422 @@ def img_to_vid(images_dir, decision_vector):
         raise Exception("Failed transcode")
 
 
-def vid_to_img(images_dir):
+def get_video_input(images_dir, input_args):
+    '''
+    Returns the ffmpeg input of images_dir. Frame stores are read as raw video
+    from stdin, in which case their frames are returned alongside the input
+    '''
+    if fstore.has_store(images_dir):
+        _, frames = fstore.open_store(images_dir)
+        raw_args = {key: val for key, val in input_args.items() if key != "pattern_type"}
+        frame_size = str(frames.shape[2]) + "x" + str(frames.shape[1])
+        return ffmpeg.input("pipe:", format="rawvideo", pix_fmt="rgb24", s=frame_size, **raw_args), frames
+
+    filenaming = str(images_dir+'/'+'*.'+ cfg.IMAGE_TYPE)
+    return ffmpeg.input(filenaming, **input_args), None
+
+
+def run_ffmpeg(stream, frames=None):
+    '''
+    Runs an ffmpeg stream, raises ffmpeg.Error if ffmpeg fails.
+    If frames are given they are piped to the stdin of ffmpeg as raw video
+    '''
+    stream = stream.global_args('-loglevel', 'error', "-stats", "-hide_banner", "-y")
+    if frames is None:
+        stream.run(capture_stderr=True)
+        return
+
+    process = stream.run_async(pipe_stdin=True, pipe_stderr=True)
+    writer = start_frame_writer(process, frames)
+    stderr = process.stderr.read()
+    writer.join()
+    if process.wait() != 0:
+        raise ffmpeg.Error("ffmpeg", None, stderr)
+
+
+def start_frame_writer(process, frames):
+    '''
+    Starts a thread which pipes frames to the stdin of an ffmpeg process as raw video
+    '''
+    def write_frames(pipe):
+        try:
+            for frame in frames: pipe.write(frame.tobytes())
+        except BrokenPipeError:
+            logger.debug("ffmpeg closed stdin before all frames were written")
+        finally:
+            pipe.close()
+
+    writer = threading.Thread(target=write_frames, args=(process.stdin,))
+    writer.start()
+    return writer
+
+
+def vid_to_img(images_dir, file_dir, frame_indices=None, source=None):
     '''
-    Converts a video-file to a set of images
+    Converts a video-file to a set of images.
+    If frame_indices is given only those frames are written.
+    If source, (source directory, input arguments), is given the written
+    frames are compared with their source in the same ffmpeg run
+    (get_decode_outputs), the statistics are written next to the video-file
     '''
     logger.debug("Vid -> Img")
     filenaming = images_dir + '/' +cfg.NAMING_SCHEME + '.' +  cfg.IMAGE_TYPE
-    file_dir = cfg.TEMP_STORAGE_PATH
     logger.debug("Filenaming: " + filenaming + " Comp_lvl: " + str(cfg.IMG_COMP_LVL))
 
     try:
-        ( 
-            ffmpeg
-            .input(file_dir)
-            .output(filenaming, compression_level=cfg.IMG_COMP_LVL)
-            .global_args('-loglevel', 'error', "-stats", "-hide_banner", "-y")
-            .run(capture_stderr=True)
-        )
+        stream, source_frames = get_decode_outputs(ffmpeg.input(file_dir), filenaming, {"compression_level": cfg.IMG_COMP_LVL},
+                                                   frame_indices, source, os.path.dirname(file_dir))
+        run_ffmpeg(stream, source_frames)
     except ffmpeg.Error as ex:
         logger.critical("FFMPEG: error converting video to images")
         logger.critical(ex.stderr.decode('utf8'))
         raise Exception("Failed transcode")
 
 
-def transcode(img_path, output_dir, decision_vector):
+def vid_to_store(store_dir, file_dir, filenames, frame_indices=None, source=None):
+    '''
+    Decodes a video-file as raw video straight into a frame store,
+    the frames are named after filenames.
+    If frame_indices is given only those frames are stored.
+    If source is given the stored frames are compared with their source,
+    as in vid_to_img
+    '''
+    logger.debug("Vid -> Frame store")
+    try:
+        decode_to_store(ffmpeg.input(file_dir), get_frame_size(file_dir),
+                        store_dir, filenames, frame_indices, source, os.path.dirname(file_dir))
+    except ffmpeg.Error as ex:
+        logger.critical("FFMPEG: error converting video to frame store")
+        logger.critical(ex.stderr.decode('utf8'))
+        raise Exception("Failed transcode")
+
+
+def img_to_store(images_dir, store_dir):
+    '''
+    Decodes the images of a directory into a frame store
+    '''
+    logger.debug("Img -> Frame store")
+    filenames = get_names(images_dir)
+    filenaming = str(images_dir+'/'+'*.'+ cfg.IMAGE_TYPE)
+    try:
+        decode_to_store(ffmpeg.input(filenaming, pattern_type='glob'),
+                        get_frame_size(os.path.join(images_dir, filenames[0])),
+                        store_dir, filenames)
+    except ffmpeg.Error as ex:
+        logger.critical("FFMPEG: error converting images to frame store")
+        logger.critical(ex.stderr.decode('utf8'))
+        raise Exception("Failed transcode")
+
+
+def decode_to_store(video_input, frame_size, store_dir, filenames, frame_indices=None, source=None, stats_dir=None):
+    '''
+    Pipes the frames of an ffmpeg input as raw video into a new frame store,
+    comparing them with source if it is given (get_decode_outputs)
+    '''
+    width, height = frame_size
+    frames = fstore.create_store(store_dir, filenames, height, width)
+    stream, source_frames = get_decode_outputs(video_input, "pipe:", {"format": "rawvideo", "pix_fmt": "rgb24"},
+                                               frame_indices, source, stats_dir)
+    process = (
+        stream
+        .global_args('-loglevel', 'error', "-hide_banner")
+        .run_async(pipe_stdin=source_frames is not None, pipe_stdout=True, pipe_stderr=True)
+    )
+    writer = start_frame_writer(process, source_frames) if source_frames is not None else None
+    frame_bytes = width*height*3
+    decoded = 0
+    while(True):
+        frame = process.stdout.read(frame_bytes)
+        if len(frame) < frame_bytes: break
+        if decoded < len(filenames):
+            frames[decoded] = np.frombuffer(frame, dtype=np.uint8).reshape(height, width, 3)
+        decoded += 1
+    stderr = process.stderr.read()
+    if writer is not None: writer.join()
+    if process.wait() != 0:
+        raise ffmpeg.Error("ffmpeg", None, stderr)
+    frames.flush()
+
+    framediff = decoded - len(filenames)
+    if(framediff != 0): logger.critical("FRAMECOUNT MISSMATCH of "+str(framediff)+" frames: "+str(store_dir))
+
+
+def get_frame_size(file_path):
+    '''
+    Returns the width and height of the frames of a video- or image-file
+    '''
+    video_info = next(stream for stream in ffmpeg.probe(file_path)["streams"]
+                      if stream["codec_type"] == "video")
+    return int(video_info["width"]), int(video_info["height"])
+
+
+def get_source_dir(img_path):
+    '''
+    Returns the cached frame store of img_path if SOURCE_FRAME_CACHE is set
+    and the store exists, otherwise img_path
+    '''
+    if cfg.SOURCE_FRAME_CACHE:
+        store_dir = get_source_cache_dir(img_path)
+        if fstore.has_store(store_dir): return store_dir
+    return img_path
+
+
+def get_source_cache_dir(img_path):
+    '''
+    Returns the path of the frame store which caches the frames of img_path
+    '''
+    return os.path.join(cfg.SOURCE_CACHE_PATH, os.path.normpath(img_path).lstrip("/"))
+
+
+def cache_sources(input_dir):
+    '''
+    One-time preprocessing which decodes every clip of input_dir into a frame
+    store in SOURCE_CACHE_PATH, later encodes are fed from these stores
+    '''
+    clips = [clip for clip in sorted(os.listdir(input_dir))
+             if os.path.isdir(os.path.join(input_dir, clip))]
+    with ThreadPoolExecutor(max_workers=max(1, cfg.TRANSCODE_WORKERS)) as pool:
+        list(pool.map(lambda clip: cache_source(os.path.join(input_dir, clip)), clips))
+
+
+def cache_source(img_path):
+    '''
+    Decodes the images of img_path into a cached frame store, unless an
+    up to date store already exists
+    '''
+    store_dir = get_source_cache_dir(img_path)
+    if fstore.has_store(store_dir):
+        names, _ = fstore.open_store(store_dir)
+        if names == get_names(img_path): return
+    logger.info("Caching decoded frames of: " + img_path)
+    img_to_store(img_path, store_dir)
+
+
+def transcode(img_path, output_dir, decision_vector, frame_indices=None, quality_metrics=False):
     '''
     Handles the process of transcoding images -> compressed-video -> images
     with potential compression artifacts.
-    The function returns the file size of the compressed-video
+    Every call works in its own scratch directory under TEMP_STORAGE_DIR,
+    which is removed when the transcode finishes or fails.
+    If frame_indices is given every frame is still encoded, but only the
+    frames of frame_indices are decoded and written to output_dir.
+    The function returns the file size of the compressed-video, and the
+    quality metrics of the decoded frames (get_decode_outputs) if
+    quality_metrics is set
     '''
 
     if not os.path.isdir(output_dir):
         os.mkdir(output_dir)
 
-    filenames = get_names(img_path)
+    source_dir = get_source_dir(img_path)
+    filenames = get_frame_names(source_dir)
+    if frame_indices is not None: filenames = [filenames[i] for i in frame_indices]
 
-    tries1, tries2 = 0, 0
-    while(True):
-        try:
-            img_to_vid(img_path, decision_vector)
-            break
-        except:
-            if(tries1 < 3):
-                logger.critical("Retrying img to vid conversion")
-                tries1 += 1
-                time.sleep(240) # Give time for the failed ffmpeg process to terminate
-            else:
-                logger.critical("Transcode failed, exiting...")
-                exit(1)
-    while(True):
-        try:
-            vid_to_img(output_dir)
-            break
-        except:
-            if(tries2 < 3):
-                logger.critical("Retrying vid to img conversion")
-                tries2 += 1
-                time.sleep(240) # Give time for the failed ffmpeg process to terminate
-            else:
-                logger.critical("Transcode failed, exiting...")
-                exit(1)
-
-    vid_size = os.path.getsize(cfg.TEMP_STORAGE_PATH)
-
-    # Remove temporary video-file
-    try: 
-        os.remove(cfg.TEMP_STORAGE_PATH)
-    except Exception:
-        logger.critical("Error removing video tempfile")
-        exit(1)
+    scratch_dir = tempfile.mkdtemp(prefix="moga-", dir=cfg.TEMP_STORAGE_DIR)
+    vid_path, passlog_prefix = get_scratch_paths(scratch_dir)
+    source = (source_dir, get_codec_args(decision_vector)[0]) if quality_metrics else None
+    try:
+        tries1, tries2 = 0, 0
+        while(True):
+            try:
+                img_to_vid(source_dir, decision_vector, vid_path, passlog_prefix)
+                break
+            except:
+                if(tries1 < 3):
+                    logger.critical("Retrying img to vid conversion")
+                    tries1 += 1
+                    time.sleep(240) # Give time for the failed ffmpeg process to terminate
+                else:
+                    logger.critical("Transcode failed, exiting...")
+                    exit(1)
+        while(True):
+            try:
+                if cfg.FRAME_PIPELINE == "rawvideo": vid_to_store(output_dir, vid_path, filenames, frame_indices, source)
+                else: vid_to_img(output_dir, vid_path, frame_indices, source)
+                break
+            except:
+                if(tries2 < 3):
+                    logger.critical("Retrying vid to img conversion")
+                    tries2 += 1
+                    time.sleep(240) # Give time for the failed ffmpeg process to terminate
+                else:
+                    logger.critical("Transcode failed, exiting...")
+                    exit(1)
+
+        vid_size = os.path.getsize(vid_path)
+        if quality_metrics: metrics = read_quality_metrics(scratch_dir)
+    finally:
+        # Remove temporary video-file and pass logs
+        shutil.rmtree(scratch_dir, ignore_errors=True)
 
     # Rename the new images to their appropriate names
-    set_names(filenames, output_dir)
+    if cfg.FRAME_PIPELINE != "rawvideo": set_names(filenames, output_dir)
+    if quality_metrics: return vid_size, metrics
     return vid_size
 
 
+def get_decode_outputs(video_input, output, output_args, frame_indices=None, source=None, stats_dir=None):
+    '''
+    Returns the ffmpeg outputs which decode video_input to output, only the
+    frames of frame_indices if given, and the frames which are piped to ffmpeg.
+    If source, (source directory, input arguments), is given the decoded
+    frames are also compared with their source frames by ffmpeg's psnr and
+    ssim filters, in yuv444p, in the same run. The statistics are written to
+    stats_dir (read_quality_metrics). Frame stores are piped as the source,
+    only the frames of frame_indices
+    '''
+    if source is None:
+        return video_input.output(output, **output_args, **get_select_args(frame_indices)), None
+
+    source_input, source_frames = get_video_input(*source)
+    decoded, source_video = video_input.video, source_input.video
+    if frame_indices is not None:
+        decoded = decoded.filter("select", get_select_expr(frame_indices))
+        output_args = dict(output_args, vsync="0")
+        if source_frames is None: source_video = source_video.filter("select", get_select_expr(frame_indices))
+        else: source_frames = [source_frames[i] for i in frame_indices]
+    decoded = decoded.filter_multi_output("split")
+
+    # psnr and ssim pair frames by timestamp, the selected frames of both inputs are renumbered alike
+    encoded = decoded[1].filter("setpts", "N/(25*TB)").filter("format", "yuv444p").filter_multi_output("split")
+    source_video = source_video.filter("setpts", "N/(25*TB)").filter("format", "yuv444p").filter_multi_output("split")
+    psnr = ffmpeg.filter([encoded[0], source_video[0]], "psnr", stats_file=os.path.join(stats_dir, "psnr.log"))
+    ssim = ffmpeg.filter([encoded[1], source_video[1]], "ssim", stats_file=os.path.join(stats_dir, "ssim.log"))
+    return ffmpeg.merge_outputs(decoded[0].output(output, **output_args),
+                                psnr.output("/dev/null", format="null"),
+                                ssim.output("/dev/null", format="null")), source_frames
+
+
+def read_quality_metrics(stats_dir):
+    '''
+    Reads the statistics of the psnr and ssim filters of get_decode_outputs.
+    Returns the mean mse, psnr and ssim and the number of compared frames,
+    None if no frames were compared
+    '''
+    try:
+        mse = read_stats_file(os.path.join(stats_dir, "psnr.log"), "mse_avg")
+        ssim = read_stats_file(os.path.join(stats_dir, "ssim.log"), "All")
+    except OSError as ex:
+        logger.error("Missing quality metrics: " + str(ex))
+        return None
+    if len(mse) == 0: return None
+    return {"mse": float(np.mean(mse)), "psnr": get_psnr(np.mean(mse)),
+            "ssim": float(np.mean(ssim)), "frames": len(mse)}
+
+
+def read_stats_file(stats_path, key):
+    '''
+    Returns the per frame values of key in an ffmpeg psnr or ssim stats file
+    '''
+    values = []
+    with open(stats_path, 'r') as stats_file:
+        for line in stats_file:
+            for token in line.split():
+                if token.startswith(key + ":"): values.append(float(token[len(key)+1:]))
+    return values
+
+
+def get_psnr(mse):
+    '''PSNR of 8 bit frames from their mean squared error'''
+    if mse == 0: return float("inf")
+    return float(10*np.log10(255**2/mse))
+
+
+def combine_quality_metrics(metrics):
+    '''
+    Combines the quality metrics of several videos, weighted by their
+    number of frames. Returns an empty dict if no metrics are available
+    '''
+    metrics = [m for m in metrics if m is not None]
+    frames = sum([m["frames"] for m in metrics])
+    if frames == 0: return {}
+    mse = sum([m["mse"]*m["frames"] for m in metrics])/frames
+    ssim = sum([m["ssim"]*m["frames"] for m in metrics])/frames
+    return {"mse": mse, "psnr": get_psnr(mse), "ssim": ssim, "frames": frames}
+
+
+def get_scratch_paths(scratch_dir):
+    '''
+    Returns the temporary video-file path and the two-pass log prefix of a
+    transcode scratch directory
+    '''
+    return os.path.join(scratch_dir, "temp.mp4"), os.path.join(scratch_dir, "ffmpeg2pass")
+
+
+def transcode_clips(input_dir, output_dir, clips, decision_vector):
+    '''
+    Transcodes every clip in clips from input_dir to output_dir.
+    Up to TRANSCODE_WORKERS clips are transcoded concurrently, by all
+    processes of the machine together (transcode_worker).
+    The function returns the summed file size of the compressed-videos and
+    their combined quality metrics, empty unless QUALITY_METRICS is set
+    '''
+    def transcode_clip(clip):
+        logger.debug("Applying degredation to clip: " + input_dir + clip)
+        frame_indices = None
+        if cfg.EVAL_FRAMES_ONLY:
+            frame_indices = get_eval_frame_indices(len(get_frame_names(input_dir + clip)))
+        with transcode_worker():
+            if cfg.QUALITY_METRICS:
+                return transcode(input_dir + clip, output_dir + clip, decision_vector, frame_indices, True)
+            return transcode(input_dir + clip, output_dir + clip, decision_vector, frame_indices), None
+
+    # ffmpeg does the heavy lifting in subprocesses, threads are enough to keep them busy
+    with ThreadPoolExecutor(max_workers=max(1, cfg.TRANSCODE_WORKERS)) as pool:
+        results = list(pool.map(transcode_clip, clips))
+    return sum([vid_size for vid_size, _ in results]), combine_quality_metrics([m for _, m in results])
+
+
+@contextmanager
+def transcode_worker():
+    '''
+    Holds one of the TRANSCODE_WORKERS transcode workers of the machine.
+    Workers are file locks in TRANSCODE_LOCK_PATH, which makes them shared
+    by every process, e.g. the islands of an archipelago
+    '''
+    os.makedirs(cfg.TRANSCODE_LOCK_PATH, exist_ok=True)
+    while(True):
+        for i in range(max(1, cfg.TRANSCODE_WORKERS)):
+            lock = open(os.path.join(cfg.TRANSCODE_LOCK_PATH, str(i) + ".lock"), 'w')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock.close()
+                continue
+            try:
+                yield
+            finally:
+                lock.close()
+            return
+        time.sleep(0.1)
+
+
+def get_eval_frame_indices(no_frames):
+    '''
+    Returns the indices of the frames evaluated by the ML-algorithms,
+    Cityscapes: frame EVAL_FRAME_OFFSET of every EVAL_FRAME_PERIOD frames
+    '''
+    return [i*cfg.EVAL_FRAME_PERIOD + cfg.EVAL_FRAME_OFFSET
+            for i in range(0, no_frames//cfg.EVAL_FRAME_PERIOD)]
+
+
+def get_select_args(frame_indices):
+    '''
+    Returns the ffmpeg output arguments which only keep the frames of frame_indices
+    '''
+    if frame_indices is None: return {}
+    return {"vf": "select=" + get_select_expr(frame_indices), "vsync": "0"}
+
+
+def get_select_expr(frame_indices):
+    '''
+    Returns the expression of the select filter which keeps the frames of
+    frame_indices. not(n-i) equals eq(n,i) but has no commas to escape in
+    filter graphs
+    '''
+    return "+".join(["not(n-" + str(i) + ")" for i in frame_indices])
+
+
 def get_names(img_path):
     '''
     Get the filenames of all files in img_path
@@ -140,6 +472,17 @@ def get_names(img_path):
     return files
 
 
+def get_frame_names(img_path):
+    '''
+    Get the frame names of img_path, which is either a directory of images
+    or a frame store
+    '''
+    if fstore.has_store(img_path):
+        names, _ = fstore.open_store(img_path)
+        return names
+    return get_names(img_path)
+
+
 def set_names(filenames, img_path):
     '''
     Rename the files in img_path to filenames in filenames
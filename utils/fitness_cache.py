@@ -0,0 +1,114 @@
+# By: Oscar Andersson 2019
+
+import os, json, time, hashlib, sqlite3, logging
+import config.config as cfg
+logger = logging.getLogger('gen-alg')
+
+'''
+Persistent cache of evaluation results.
+Results are stored in an SQLite database and are addressed by what was
+actually computed: the codec, rate control, the ffmpeg arguments used,
+a fingerprint of the content of the dataset and the checkpoint of the
+ML-model. Identical encodes are therefore never paid for twice, not even
+across runs or tools.
+'''
+
+
+def get_connection():
+    '''
+    Opens the cache database, creating it if it does not exist
+    '''
+    cache_dir = os.path.dirname(cfg.FITNESS_CACHE_PATH)
+    if cache_dir and not os.path.isdir(cache_dir): os.makedirs(cache_dir, exist_ok=True)
+
+    # Several processes may share the cache, wait for their writes to finish
+    connection = sqlite3.connect(cfg.FITNESS_CACHE_PATH, timeout=60)
+    connection.execute("CREATE TABLE IF NOT EXISTS results ("
+                       "key TEXT PRIMARY KEY, codec TEXT, rate_control TEXT, "
+                       "ml_model TEXT, dataset TEXT, args TEXT, result TEXT, created REAL)")
+    connection.execute("CREATE TABLE IF NOT EXISTS file_digests ("
+                       "path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, digest TEXT)")
+    return connection
+
+
+def get_dataset_fingerprint(data_path):
+    '''
+    Returns a fingerprint of the files in data_path, based on their
+    relative paths and contents
+    '''
+    fingerprint = hashlib.sha1()
+    connection = get_connection()
+    try:
+        with connection:
+            for dirpath, dirnames, filenames in os.walk(data_path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    file_path = os.path.join(dirpath, filename)
+                    rel_path = os.path.relpath(file_path, data_path)
+                    fingerprint.update((rel_path + ":" + get_file_digest(connection, file_path) + "\n").encode('utf8'))
+    finally:
+        connection.close()
+    return fingerprint.hexdigest()
+
+
+def get_file_digest(connection, file_path):
+    '''
+    Returns the SHA-256 digest of the content of a file. Digests are kept
+    by path, size and modification time, only new or changed files are read
+    '''
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+    row = connection.execute("SELECT digest FROM file_digests WHERE path = ? AND size = ? AND mtime = ?",
+                             (file_path, stat.st_size, stat.st_mtime_ns)).fetchone()
+    if row is not None: return row[0]
+
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''): digest.update(block)
+    connection.execute("INSERT OR REPLACE INTO file_digests VALUES (?, ?, ?, ?)",
+                       (file_path, stat.st_size, stat.st_mtime_ns, digest.hexdigest()))
+    return digest.hexdigest()
+
+
+def get_key(args_key, dataset_fingerprint, model_id, extra=""):
+    '''
+    Returns the cache key of an encoding of a dataset evaluated by the
+    checkpoint model_id (rest_communication.get_model_id) of the configured ML-model.
+    args_key is the canonical string of the ffmpeg arguments, extra can
+    be used to separate results of different evaluation setups.
+    Returns None, which is never cached, if the checkpoint is unknown
+    '''
+    if model_id is None: return None
+    key_data = [cfg.video_encoder, cfg.rate_control, cfg.ML_MODEL, model_id,
+                dataset_fingerprint, args_key, extra]
+    return hashlib.sha256(json.dumps(key_data).encode('utf8')).hexdigest()
+
+
+def lookup(key):
+    '''
+    Returns the cached result of key, None if there is no such result
+    '''
+    if not cfg.USE_FITNESS_CACHE or key is None: return None
+    connection = get_connection()
+    try:
+        row = connection.execute("SELECT result FROM results WHERE key = ?", (key,)).fetchone()
+    finally:
+        connection.close()
+    if row is None: return None
+    logger.debug("Fitness cache hit: " + key)
+    return json.loads(row[0])
+
+
+def store(key, result, args_key="", dataset_fingerprint=""):
+    '''
+    Stores a JSON serialisable result under key
+    '''
+    if not cfg.USE_FITNESS_CACHE or key is None: return
+    connection = get_connection()
+    try:
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               (key, cfg.video_encoder, cfg.rate_control, cfg.ML_MODEL,
+                                dataset_fingerprint, args_key, json.dumps(result), time.time()))
+    finally:
+        connection.close()
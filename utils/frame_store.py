@@ -0,0 +1,56 @@
+# By: Oscar Andersson 2019
+
+import os, json, logging
+import numpy as np
+logger = logging.getLogger('gen-alg')
+
+'''
+Frame stores keep the frames of a clip as raw rgb24 pixels in one
+memory-mapped .npy file, together with a json file holding the frame
+names. Frames can be piped to and from ffmpeg and read by evaluators
+without any image compression in between.
+'''
+
+FRAMES_FILE = "frames.npy"
+NAMES_FILE = "frames.json"
+
+
+def has_store(store_dir):
+    '''
+    Returns True if store_dir contains a frame store
+    '''
+    return (os.path.isfile(os.path.join(store_dir, FRAMES_FILE)) and
+            os.path.isfile(os.path.join(store_dir, NAMES_FILE)))
+
+
+def create_store(store_dir, names, height, width):
+    '''
+    Creates a frame store for the frames in names in store_dir.
+    Returns a writable memory-map of shape (frames, height, width, 3)
+    '''
+    if not os.path.isdir(store_dir): os.makedirs(store_dir, exist_ok=True)
+    with open(os.path.join(store_dir, NAMES_FILE), 'w') as names_file:
+        json.dump(list(names), names_file)
+    return np.lib.format.open_memmap(os.path.join(store_dir, FRAMES_FILE), mode='w+',
+                                     dtype=np.uint8, shape=(len(names), height, width, 3))
+
+
+def open_store(store_dir, mode='r'):
+    '''
+    Opens the frame store of store_dir.
+    Returns the frame names and a memory-map of the frames, read-only
+    unless mode is 'r+'
+    '''
+    with open(os.path.join(store_dir, NAMES_FILE), 'r') as names_file:
+        names = json.load(names_file)
+    frames = np.load(os.path.join(store_dir, FRAMES_FILE), mmap_mode=mode)
+    return names, frames
+
+
+def read_frame(store_dir, name):
+    '''
+    Returns the frame called name of the frame store in store_dir
+    '''
+    names, frames = open_store(store_dir)
+    return np.array(frames[names.index(name)])
+
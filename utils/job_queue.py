@@ -0,0 +1,160 @@
+# By: Oscar Andersson 2019
+
+import os, json, time, sqlite3, logging
+import config.config as cfg
+logger = logging.getLogger('gen-alg')
+
+'''
+Queue of evaluation jobs, stored in an SQLite database.
+The optimisation submits chromosomes as jobs, evaluation workers
+(tools/eval-worker.py) lease them, transcode and evaluate them with their
+own ML-algorithm and post the results back. A lease expires unless the
+worker renews it, so the job of a crashed worker is re-queued and leased
+by another worker.
+'''
+
+
+def get_connection():
+    '''
+    Opens the queue database, creating it if it does not exist
+    '''
+    queue_dir = os.path.dirname(cfg.JOB_QUEUE_PATH)
+    if queue_dir and not os.path.isdir(queue_dir): os.makedirs(queue_dir, exist_ok=True)
+
+    # Transactions are begun explicitly, a job must only be leased by one worker
+    connection = sqlite3.connect(cfg.JOB_QUEUE_PATH, timeout=60, isolation_level=None)
+    connection.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                       "id INTEGER PRIMARY KEY AUTOINCREMENT, job TEXT, state TEXT, worker TEXT, "
+                       "lease_expires REAL, attempts INTEGER, result TEXT, error TEXT, created REAL)")
+    return connection
+
+
+def submit(x, fidelity="full"):
+    '''
+    Submits an evaluation job of decision vector x, at full or low fidelity.
+    The runtime configuration of the optimisation is sent along, workers
+    interpret x with it. Returns the id of the job
+    '''
+    job = {"x": [float(val) for val in x], "fidelity": fidelity, "run_state": cfg.get_run_state()}
+    connection = get_connection()
+    try:
+        cursor = connection.execute("INSERT INTO jobs (job, state, attempts, created) VALUES (?, 'queued', 0, ?)",
+                                    (json.dumps(job), time.time()))
+        return cursor.lastrowid
+    finally:
+        connection.close()
+
+
+def lease(worker):
+    '''
+    Leases the oldest queued job to worker, after re-queueing jobs whose
+    lease has expired. Returns the job, with its id, or None if the queue is empty
+    '''
+    connection = get_connection()
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            expire_leases(connection, now)
+            row = connection.execute("SELECT id, job FROM jobs WHERE state = 'queued' ORDER BY id LIMIT 1").fetchone()
+            if row is not None:
+                connection.execute("UPDATE jobs SET state = 'leased', worker = ?, lease_expires = ?, "
+                                   "attempts = attempts + 1 WHERE id = ?", (worker, now + cfg.JOB_LEASE_TIME, row[0]))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+    finally:
+        connection.close()
+
+    if row is None: return None
+    job = json.loads(row[1])
+    job["id"] = row[0]
+    return job
+
+
+def expire_leases(connection, now):
+    '''
+    Re-queues the jobs whose lease has expired, jobs which have been
+    attempted JOB_MAX_ATTEMPTS times fail, e.g. jobs which crash their worker
+    '''
+    failed = connection.execute("UPDATE jobs SET state = 'failed', worker = NULL, error = 'Lease expired' "
+                                "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                                (now, cfg.JOB_MAX_ATTEMPTS)).rowcount
+    requeued = connection.execute("UPDATE jobs SET state = 'queued', worker = NULL "
+                                  "WHERE state = 'leased' AND lease_expires < ?", (now,)).rowcount
+    if failed > 0: logger.warning("Failed " + str(failed) + " jobs with expired leases after " + str(cfg.JOB_MAX_ATTEMPTS) + " attempts")
+    if requeued > 0: logger.warning("Re-queued " + str(requeued) + " jobs with expired leases")
+
+
+def renew(job_id, worker):
+    '''
+    Extends the lease of a job held by worker.
+    Returns False if the worker no longer holds the job
+    '''
+    connection = get_connection()
+    try:
+        return connection.execute("UPDATE jobs SET lease_expires = ? WHERE id = ? AND state = 'leased' AND worker = ?",
+                                  (time.time() + cfg.JOB_LEASE_TIME, job_id, worker)).rowcount > 0
+    finally:
+        connection.close()
+
+
+def complete(job_id, worker, result):
+    '''
+    Posts the JSON serialisable result of a job held by worker
+    '''
+    connection = get_connection()
+    try:
+        done = connection.execute("UPDATE jobs SET state = 'done', result = ? WHERE id = ? AND state = 'leased' AND worker = ?",
+                                  (json.dumps(result), job_id, worker)).rowcount > 0
+    finally:
+        connection.close()
+    if not done: logger.warning("Lease of job " + str(job_id) + " was lost, result discarded")
+
+
+def fail(job_id, worker, error):
+    '''
+    Returns a job held by worker to the queue after an error, the job fails
+    for good after JOB_MAX_ATTEMPTS attempts
+    '''
+    connection = get_connection()
+    try:
+        connection.execute("UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+                           "worker = NULL, error = ? WHERE id = ? AND state = 'leased' AND worker = ?",
+                           (cfg.JOB_MAX_ATTEMPTS, error, job_id, worker))
+    finally:
+        connection.close()
+
+
+def wait(job_id):
+    '''
+    Waits for a job to finish and returns its result.
+    Expired leases are handled while waiting, so jobs of crashed workers
+    fail even if no worker is left to lease jobs
+
+    Raises
+    ------
+    Exception
+        If the job failed or did not finish within JOB_WAIT_TIMEOUT seconds of its submission
+    '''
+    while(True):
+        connection = get_connection()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                expire_leases(connection, time.time())
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            state, result, error, created = connection.execute("SELECT state, result, error, created FROM jobs WHERE id = ?",
+                                                               (job_id,)).fetchone()
+        finally:
+            connection.close()
+        if state == 'done': return json.loads(result)
+        if state == 'failed': raise Exception("Evaluation job " + str(job_id) + " failed: " + str(error))
+        if time.time() - created > cfg.JOB_WAIT_TIMEOUT:
+            raise Exception("Evaluation job " + str(job_id) + " not finished after " + str(cfg.JOB_WAIT_TIMEOUT) +
+                            " seconds, are any workers running?")
+        time.sleep(cfg.JOB_POLL_INTERVAL)
@@ -0,0 +1,69 @@
+# By: Oscar Andersson 2019
+
+import os, shutil, logging
+import config.config as cfg
+import utils.ffmpeg_utils as ffu
+logger = logging.getLogger('gen-alg')
+
+'''
+Low-fidelity dataset of the multi-fidelity mode.
+The subset is stratified over the clips of the dataset: every clip keeps
+every MULTI_FIDELITY_STRIDE:th of its annotated sequences (EVAL_FRAME_PERIOD
+frames each), so every clip is represented and the evaluated frames keep
+their position in the sequences.
+'''
+
+
+def get_subset_indices(no_frames):
+    '''
+    Returns the indices of the frames of a clip which belong to the subset
+    '''
+    indices = []
+    for seq in range(0, no_frames//cfg.EVAL_FRAME_PERIOD, cfg.MULTI_FIDELITY_STRIDE):
+        indices += range(seq*cfg.EVAL_FRAME_PERIOD, (seq+1)*cfg.EVAL_FRAME_PERIOD)
+    return indices
+
+
+def create_subset(input_dir, subset_dir):
+    '''
+    Creates the subset of the clips of input_dir in subset_dir, unless it is up to date.
+    Frames are hard linked when possible.
+    Returns the names of the evaluated frames of the subset
+    '''
+    eval_names = []
+    for clip in sorted(os.listdir(input_dir)):
+        clip_path = os.path.join(input_dir, clip)
+        if not os.path.isdir(clip_path): continue
+        names = ffu.get_names(clip_path)
+        subset_names = [names[i] for i in get_subset_indices(len(names))]
+        eval_names += [subset_names[i] for i in ffu.get_eval_frame_indices(len(subset_names))]
+
+        subset_path = os.path.join(subset_dir, clip)
+        if os.path.isdir(subset_path) and ffu.get_names(subset_path) == subset_names: continue
+        logger.info("Creating low-fidelity subset of: " + clip_path)
+        shutil.rmtree(subset_path, ignore_errors=True)
+        os.makedirs(subset_path)
+        for name in subset_names:
+            try:
+                os.link(os.path.join(clip_path, name), os.path.join(subset_path, name))
+            except OSError:
+                shutil.copy2(os.path.join(clip_path, name), os.path.join(subset_path, name))
+    return eval_names
+
+
+def write_eval_list(eval_names):
+    '''
+    Writes the evaluation list of the subset for ML-algorithms which are
+    evaluated on a list of images (ML_DATA_LIST), containing the entries of
+    the full list which refer to eval_names
+    '''
+    if cfg.ML_DATA_LIST is None: return
+    eval_names = set(eval_names)
+    with open(os.path.join(cfg.ML_DATA_ROOT, cfg.ML_DATA_LIST), 'r') as list_file:
+        entries = [line for line in list_file if line.strip() and os.path.basename(line.split()[0]) in eval_names]
+
+    list_path = os.path.join(cfg.ML_DATA_ROOT, "list", "cityscape_eval", cfg.MULTI_FIDELITY_LIST + ".lst")
+    os.makedirs(os.path.dirname(list_path), exist_ok=True)
+    with open(list_path, 'w') as list_file:
+        list_file.writelines(entries)
+    logger.info("Low-fidelity evaluation list: " + str(len(entries)) + " images")
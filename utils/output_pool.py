@@ -0,0 +1,89 @@
+# By: Oscar Andersson 2019
+
+import os, time, fcntl, shutil, threading, logging
+import config.config as cfg
+logger = logging.getLogger('gen-alg')
+
+'''
+Pool of output directories for degraded clips.
+Every evaluation gets a slot of its own, a directory which mirrors the
+dataset root of the ML-algorithm (ML_DATA_ROOT): degraded clips are written
+to the image directory of the slot, everything listed in ML_DATA_SHARED is
+linked from the original root. Several evaluations can therefore be in
+flight at once. Slots are locked with file locks, which makes the pool safe
+to share between threads and processes, and released slots are emptied in
+the background.
+'''
+
+
+def acquire_slot():
+    '''
+    Waits for a free slot and locks it.
+    Returns the root directory of the slot and its lock, which is passed to release_slot
+    '''
+    if not os.path.isdir(cfg.ML_DATA_POOL_PATH): os.makedirs(cfg.ML_DATA_POOL_PATH, exist_ok=True)
+    while(True):
+        for i in range(cfg.ML_DATA_POOL_SIZE):
+            slot_root = os.path.join(cfg.ML_DATA_POOL_PATH, str(i))
+            lock = open(slot_root + ".lock", 'w')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock.close()
+                continue
+            prepare_slot(slot_root)
+            logger.debug("Acquired output slot: " + slot_root)
+            return slot_root, lock
+        time.sleep(1)
+
+
+def release_slot(slot_root, lock):
+    '''
+    Empties the image directory of a slot in the background and unlocks
+    the slot when it is done
+    '''
+    def empty_and_unlock():
+        try:
+            empty_slot(slot_root)
+        finally:
+            lock.close()
+
+    threading.Thread(target=empty_and_unlock, daemon=True).start()
+
+
+def get_output_dir(slot_root):
+    '''
+    Returns the directory of a slot which the degraded clips are written to
+    '''
+    return os.path.join(slot_root, os.path.relpath(cfg.ML_DATA_OUTPUT, cfg.ML_DATA_ROOT)) + "/"
+
+
+def get_eval_dir(slot_root):
+    '''
+    Returns the root of a slot relative to ML_DATA_BASE, as sent to the ML-algorithm
+    '''
+    return os.path.relpath(slot_root, cfg.ML_DATA_BASE)
+
+
+def prepare_slot(slot_root):
+    '''
+    Creates the directories and links of a slot. Clips left behind by an
+    interrupted evaluation are removed.
+    '''
+    output_dir = get_output_dir(slot_root)
+    if os.path.isdir(output_dir) and os.listdir(output_dir): empty_slot(slot_root)
+    os.makedirs(output_dir, exist_ok=True)
+
+    for shared in cfg.ML_DATA_SHARED:
+        link = os.path.join(slot_root, shared)
+        if os.path.islink(link): continue
+        os.makedirs(os.path.dirname(link), exist_ok=True)
+        # Relative links resolve in every container that mounts the data directory
+        os.symlink(os.path.relpath(os.path.join(cfg.ML_DATA_ROOT, shared), os.path.dirname(link)), link)
+
+
+def empty_slot(slot_root):
+    '''Removes all degraded clips of a slot'''
+    output_dir = get_output_dir(slot_root)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir, exist_ok=True)
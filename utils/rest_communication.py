@@ -4,10 +4,11 @@ logger = logging.getLogger('gen-alg')
 
 
 # TODO: This function is tailored for HRNet, changes to it may be needed for other ML systems
-def get_eval_from_ml_alg(eval_list = None):
+def get_eval_from_ml_alg(eval_list = None, eval_dir = None):
     '''
     Sends an evaluation request to the machine learning system.
-    The ML system will use the data stored in ML_DATA_OUTPUT as validation set.
+    The ML system will use the data stored in ML_DATA_OUTPUT as validation set,
+    or the dataset root eval_dir (relative to ML_DATA_BASE) if it is given.
 
     Raises
     ------
@@ -18,9 +19,11 @@ def get_eval_from_ml_alg(eval_list = None):
     -------
     ML-performance measurement
     '''
-    payload = ""
+    payload = {}
     if(eval_list != None):
-        payload = {"eval_list": eval_list}
+        payload["eval_list"] = eval_list
+    if(eval_dir != None):
+        payload["eval_dir"] = eval_dir
     response = requests.get(cfg.REQUEST_ADDRESS, params=payload, timeout=120*60)
 
     if(response.status_code != 200):
@@ -33,6 +36,21 @@ def get_eval_from_ml_alg(eval_list = None):
 
 
 
+def get_model_id():
+    '''
+    Returns the identity of the checkpoint which the ML-algorithm evaluates
+    with, None if the ML-algorithm cannot be reached or does not report it
+    '''
+    try:
+        response = requests.get(cfg.MODEL_ADDRESS, timeout=60)
+        if(response.status_code == 200): return response.json()["model_id"]
+        logger.warning("ML-algorithm did not report its checkpoint, status: " + str(response.status_code))
+    except (requests.RequestException, ValueError, KeyError) as ex:
+        logger.warning("Could not request the checkpoint of the ML-algorithm: " + str(ex))
+    return None
+
+
+
 if(__name__ == "__main__"):  
     # Main function for debugging communication
     eval_res = get_eval_from_ml_alg()
@@ -0,0 +1,180 @@
+# By: Oscar Andersson 2019
+
+import os, re, csv, glob, logging
+import numpy as np
+import config.config as cfg
+logger = logging.getLogger('gen-alg')
+
+'''
+Surrogate of the fitness function, used by the surrogate mode of moga.py.
+Both objectives are modelled by Gaussian processes trained on the
+decision vectors and fitness recorded in the data.csv files of earlier
+evaluations. The compression objective is modelled in logarithmic scale,
+compression ratios span several orders of magnitude.
+'''
+
+
+def load_history(results_path):
+    '''
+    Returns the decision vectors and fitness of every evaluation recorded in
+    the data.csv files of results_path which used the current encoder, rate
+    control and ML-model, at most SURROGATE_MAX_HISTORY of the latest
+    '''
+    history = []
+    for data_path in glob.glob(os.path.join(results_path, "*", "data.csv")):
+        with open(data_path, mode='r') as data_file:
+            for row in csv.reader(data_file, delimiter=',', quotechar='"'):
+                # calls, epoch, encoder, moga, x, time, fitness (2), ML-measures, rate control, ML-model, fidelity
+                if(len(row) < 11 or row[2] != cfg.video_encoder or
+                   row[9] != cfg.rate_control or row[10] != cfg.ML_MODEL): continue
+                if len(row) > 11 and row[11] != "full": continue
+                x = [float(val) for val in re.split(r"[\s,]+", row[4].strip("[] \n")) if val != ""]
+                if len(x) != len(cfg.opt_params): continue
+                history.append((os.path.getmtime(data_path), int(row[0]), x, [float(row[6]), float(row[7])]))
+
+    # Keep the latest evaluations, ordered by run and fitness-call
+    history.sort(key=lambda evaluation: evaluation[:2])
+    history = history[-cfg.SURROGATE_MAX_HISTORY:]
+    X = np.array([x for _, _, x, _ in history]).reshape(-1, len(cfg.opt_params))
+    F = np.array([f for _, _, _, f in history]).reshape(-1, 2)
+    return X, F
+
+
+def to_model_space(F):
+    '''
+    Transforms fitness values [-score, -comp_ratio] to the modelled
+    objectives [-score, -log(comp_ratio)], which have the same Pareto order
+    '''
+    F = np.array(F, dtype=float).reshape(-1, 2)
+    return np.column_stack((F[:, 0], -np.log(-F[:, 1])))
+
+
+class fitness_surrogate:
+    '''
+    Models both objectives of the fitness function, in model space (to_model_space)
+    '''
+
+    def __init__(self, X, F):
+        low, high = np.array(cfg.opt_low_bounds, dtype=float), np.array(cfg.opt_high_bounds, dtype=float)
+        self.low = low
+        self.scale = np.where(high > low, high - low, 1.0)
+        Y = to_model_space(F)
+        self.models = [gaussian_process().fit(self.normalise(X), Y[:, i]) for i in range(2)]
+
+
+    def normalise(self, X):
+        '''Scales decision vectors to the unit box of the bounds'''
+        return (np.array(X, dtype=float).reshape(-1, len(self.low)) - self.low) / self.scale
+
+
+    def predict(self, X):
+        '''
+        Returns the predicted objectives of decision vectors X in model space,
+        and their standard deviations in units of the standard deviation of the history
+        '''
+        predictions = [model.predict(self.normalise(X)) for model in self.models]
+        mean = np.column_stack([mean for mean, _ in predictions])
+        std = np.column_stack([std for _, std in predictions])
+        return mean, std
+
+
+class gaussian_process:
+    '''
+    Gaussian process regression with a squared exponential kernel.
+    The length scale and noise level are chosen by maximum marginal likelihood.
+    Length scales are relative to sqrt(dimensions), the typical distance
+    between points of the unit box, since the distances between chromosomes
+    grow with the number of encoder parameters
+    '''
+
+    LENGTH_SCALES = (0.05, 0.1, 0.2, 0.4, 0.8, 1.6)
+    NOISE_LEVELS = (1e-3, 1e-2, 1e-1)
+
+    X = None
+    y_mean = None
+    y_std = None
+    length_scale = None
+    L = None
+    alpha = None
+
+
+    def fit(self, X, y):
+        self.X = X
+        self.y_mean = np.mean(y)
+        self.y_std = np.std(y) if np.std(y) > 0 else 1.0
+        y = (y - self.y_mean) / self.y_std
+
+        sq_dists = get_sq_dists(X, X)
+        best_lml = None
+        for length_scale in np.array(self.LENGTH_SCALES) * np.sqrt(X.shape[1]):
+            for noise in self.NOISE_LEVELS:
+                K = np.exp(-0.5 * sq_dists / length_scale**2) + noise * np.eye(len(X))
+                try:
+                    L = np.linalg.cholesky(K)
+                except np.linalg.LinAlgError:
+                    continue
+                alpha = np.linalg.solve(L.T, np.linalg.solve(L, y))
+                lml = -0.5 * np.dot(y, alpha) - np.sum(np.log(np.diag(L))) - 0.5 * len(X) * np.log(2 * np.pi)
+                if best_lml is None or lml > best_lml:
+                    best_lml = lml
+                    self.length_scale, self.L, self.alpha = length_scale, L, alpha
+
+        logger.debug("Surrogate length scale: " + str(self.length_scale) + " log marginal likelihood: " + str(best_lml))
+        return self
+
+
+    def predict(self, X):
+        '''
+        Returns the predicted mean of X and the standard deviation of the
+        prediction, in units of the standard deviation of the training targets
+        '''
+        K_s = np.exp(-0.5 * get_sq_dists(X, self.X) / self.length_scale**2)
+        mean = np.dot(K_s, self.alpha) * self.y_std + self.y_mean
+        v = np.linalg.solve(self.L, K_s.T)
+        var = np.clip(1.0 - np.sum(v**2, axis=0), 0, None)
+        return mean, np.sqrt(var)
+
+
+def get_sq_dists(A, B):
+    '''Squared euclidean distances between the rows of A and B'''
+    sq_dists = np.sum(A**2, axis=1)[:, None] + np.sum(B**2, axis=1)[None, :] - 2 * np.dot(A, B.T)
+    return np.clip(sq_dists, 0, None)
+
+
+class surrogate_problem:
+    '''
+    A PyGMO User Defined Problem with the bounds of sweetspot_problem whose
+    fitness is predicted by a fitness_surrogate, in model space
+    '''
+
+    surrogate = None
+
+
+    def __init__(self, surrogate):
+        self.surrogate = surrogate
+
+
+    def get_name(self):
+        return "Sweetspot surrogate problem"
+
+
+    def get_nobj(self):
+        return 2
+
+
+    def get_bounds(self):
+        return (cfg.opt_low_bounds, cfg.opt_high_bounds)
+
+
+    def get_nix(self):
+        return len(cfg.opt_params)-cfg.no_continous
+
+
+    def fitness(self, x):
+        mean, _ = self.surrogate.predict(x)
+        return mean[0]
+
+
+    def batch_fitness(self, dvs):
+        mean, _ = self.surrogate.predict(np.reshape(dvs, (-1, len(cfg.opt_params))))
+        return mean.flatten()